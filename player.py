@@ -3,16 +3,28 @@
 import os
 import re
 import json
+import heapq
+import sqlite3
+import hashlib
+import threading
+import mmap
 from enum import Enum
-from io import FileIO
+from io import BytesIO
 from math import sqrt
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
 import pyaudio
 import numpy as np
 import pydub
 from PyQt5 import QtCore, QtGui, QtWidgets, QtNetwork, uic
 
 SegmentInfo = namedtuple('SegmentInfo', 'file length')
+# a segment file in the cache; lastAccess is in milliseconds since epoch
+CacheEntry = namedtuple('CacheEntry', 'file size lastAccess')
+# decoded audio: int16 frames (interleaved, shaped as frames x channels)
+# and their sample rate
+DecodedSegment = namedtuple('DecodedSegment', 'data rate')
+# start and end are in milliseconds since epoch
+ScheduledRecording = namedtuple('ScheduledRecording', 'radio start end title')
 NetworkErrors = {}
 for _k, _v in QtNetwork.QNetworkReply.__dict__.items():
     if isinstance(_v, QtNetwork.QNetworkReply.NetworkError):
@@ -28,10 +40,31 @@ else:
     os.environ.update({'KDE_FULL_SESSION': ''})
 
 VolumeStep = 10
+# segment download priorities, lower values first
+PlayPriority, ReadAheadPriority, RecordPriority, BackgroundPriority = range(4)
+# bytes copied at once when exporting a recording without sendfile
+ExportChunkSize = 1048576
+# maximum number of cache files removed at once
+EvictionBatch = 32
+
+AdtsFrameSamples = 1024
+PrerollFrames = 2
+# latency profiles (low, balanced, robust): PyAudio frames per buffer, ring
+# buffer size in seconds and how many segments are decoded in advance
+LatencyProfiles = (
+    (256, .75, 1), 
+    (1024, 3, 2), 
+    (4096, 12, 4), 
+    )
 
 FindIndexRegEx = re.compile('\d+')
+FindMediaSequenceRegEx = re.compile(rb'#EXT-X-MEDIA-SEQUENCE:(\d+)')
+FindCanSkipRegEx = re.compile(rb'#EXT-X-SERVER-CONTROL:.*CAN-SKIP-UNTIL=([\d.]+)')
 BaseStreamUrl = 'https://lsaplus.swisstxt.ch/audio/{}_96.stream/'
 PlaylistFileName = 'chunklist_DVR.m3u8'
+# the DVR window is 2160 segments (6 hours), segments are kept in memory for
+# one more hour
+PlaylistSegmentLimit = 2520
 SongLogBaseUrl = 'https://www.rsi.ch/play/radio/songlog/'
 NowAndNextBaseUrl = 'https://www.rsi.ch/play/radio/now-and-next/'
 #'https://www.rsi.ch/play/radio/now-and-next/rete-due?livestreamId=livestream_ReteDue'
@@ -57,6 +90,8 @@ IconSizes = [QtCore.QSize(s, s) for s in (16, 20, 22, 24, 32, 64, 128, 256)]
 StartRole = QtCore.Qt.UserRole + 1000
 EndRole = StartRole + 1
 RecordFileRole = QtCore.Qt.UserRole + 1500
+AdtsSampleRates = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 
+    16000, 12000, 11025, 8000, 7350)
 
 RecStart = QtGui.QPainterPath()
 RecStart.moveTo(1, 1)
@@ -154,37 +189,692 @@ for _errorName, _errorValue in PlaylistResultEnum.__members__.items():
     setattr(PlaylistResult, _errorName, lambda v=None, e=_errorName: PlaylistResult(v, e))
 
 
-class MultiFileObject(FileIO):
-    second = None
-    def __init__(self, first, second=None):
-        self.first = open(first, 'rb')
-        if second:
-            self.second = open(second, 'rb')
+class SegmentIndex(object):
+    # Playlist contents of a radio, kept in parallel arrays sorted by index:
+    # segment lengths, the id of their file name template and the cumulative
+    # length (in milliseconds) before each segment, so that index to time and
+    # time to index are just binary searches.
+    # bounds has one more item than indexes: bounds[p] is the start of the
+    # segment at position p, bounds[p + 1] its end.
+    # starts contains the absolute start time of each segment (milliseconds
+    # since epoch), or -1 until it is known.
+    # It also behaves as a read only {index: SegmentInfo} dict.
+    def __init__(self, limit=PlaylistSegmentLimit):
+        self.limit = limit
+        self.count = 0
+        self.templates = []
+        self.templateIds = {}
+        self.allocate(256)
+
+    def allocate(self, size):
+        indexes = np.zeros(size, dtype=np.int64)
+        lengths = np.zeros(size, dtype=np.int32)
+        fileIds = np.zeros(size, dtype=np.int16)
+        starts = np.zeros(size, dtype=np.int64)
+        bounds = np.zeros(size + 1, dtype=np.int64)
+        if self.count:
+            indexes[:self.count] = self.indexes
+            lengths[:self.count] = self.lengths
+            fileIds[:self.count] = self._fileIds[:self.count]
+            starts[:self.count] = self.starts
+            bounds[:self.count + 1] = self.bounds
+        self._indexes, self._lengths, self._fileIds, self._starts, self._bounds = (
+            indexes, lengths, fileIds, starts, bounds)
 
-    def seek(self, pos):
-        pass
+    @property
+    def indexes(self):
+        return self._indexes[:self.count]
+
+    @property
+    def lengths(self):
+        return self._lengths[:self.count]
+
+    @property
+    def starts(self):
+        return self._starts[:self.count]
+
+    @property
+    def bounds(self):
+        return self._bounds[:self.count + 1]
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, index):
+        return self.position(index) >= 0
+
+    def __getitem__(self, index):
+        pos = self.position(index)
+        if pos < 0:
+            raise KeyError(index)
+        return self.info(pos)
+
+    def get(self, index, default=None):
+        pos = self.position(index)
+        if pos < 0:
+            return default
+        return self.info(pos)
+
+    def keys(self):
+        return self.indexes.tolist()
+
+    def values(self):
+        return [self.info(pos) for pos in range(self.count)]
+
+    def items(self):
+        return [(index, self.info(pos)) for pos, index in enumerate(self.keys())]
+
+    def info(self, pos):
+        pre, width, post = self.templates[self._fileIds[pos]]
+        return SegmentInfo('{}{:0{}d}{}'.format(pre, int(self._indexes[pos]), width, post), 
+            int(self._lengths[pos]))
+
+    def templateId(self, fileName):
+        # file names only differ for the index, so only the parts before and
+        # after it are stored (and the zero padding, if any)
+        match = list(FindIndexRegEx.finditer(fileName))[-1]
+        digits = match.group()
+        template = (fileName[:match.start()], 
+            len(digits) if digits.startswith('0') else 0, 
+            fileName[match.end():])
+        templateId = self.templateIds.get(template)
+        if templateId is None:
+            templateId = self.templateIds[template] = len(self.templates)
+            self.templates.append(template)
+        return templateId
+
+    def totalLength(self):
+        return int(self._bounds[self.count])
+
+    def position(self, index):
+        pos = int(np.searchsorted(self.indexes, index))
+        if pos < self.count and self._indexes[pos] == index:
+            return pos
+        return -1
+
+    def add(self, index, fileName, length, start=-1):
+        count = self.count
+        if count and index <= self._indexes[count - 1]:
+            pos = int(np.searchsorted(self.indexes, index))
+            if self._indexes[pos] == index:
+                return
+        else:
+            pos = count
+        if count == len(self._indexes):
+            self.allocate(count * 2)
+        fileId = self.templateId(fileName)
+        if start < 0:
+            # without a program date time, follow the adjacent segments
+            if pos and self._indexes[pos - 1] == index - 1 and self._starts[pos - 1] >= 0:
+                start = self._starts[pos - 1] + self._lengths[pos - 1]
+            elif pos < count and self._indexes[pos] == index + 1 and self._starts[pos] >= 0:
+                start = self._starts[pos] - length
+        if pos == count:
+            # the usual case, new segments are at the end of the playlist
+            self._indexes[pos] = index
+            self._lengths[pos] = length
+            self._fileIds[pos] = fileId
+            self._starts[pos] = start
+            self._bounds[pos + 1] = self._bounds[pos] + length
+        else:
+            for array in (self._indexes, self._lengths, self._fileIds, self._starts):
+                array[pos + 1:count + 1] = array[pos:count].copy()
+            self._indexes[pos] = index
+            self._lengths[pos] = length
+            self._fileIds[pos] = fileId
+            self._starts[pos] = start
+            np.cumsum(self._lengths[pos:count + 1], out=self._bounds[pos + 1:count + 2])
+            self._bounds[pos + 1:count + 2] += self._bounds[pos]
+        self.count += 1
+
+    def setEndTime(self, msecs):
+        # segments with unknown start time are placed relative to the last
+        # known one or, if none is known, assuming that the last segment ends
+        # at the given time (usually the playlist request)
+        starts = self.starts
+        unknown = starts < 0
+        if not unknown.any():
+            return
+        known = np.flatnonzero(~unknown)
+        if len(known):
+            origin = starts[known[-1]] - self._bounds[known[-1]]
+        else:
+            origin = msecs - self.totalLength()
+        starts[unknown] = origin + self.bounds[:-1][unknown]
+
+    def clear(self):
+        self.count = 0
+
+    def trim(self):
+        # forget the oldest segments, outside the DVR window and its margin;
+        # this is done in chunks, to avoid moving the arrays at each playlist
+        if self.count <= self.limit + 256:
+            return
+        first = self.count - self.limit
+        for array in (self._indexes, self._lengths, self._fileIds, self._starts):
+            array[:self.limit] = array[first:self.count].copy()
+        self._bounds[:self.limit + 1] = self._bounds[first:self.count + 1] - self._bounds[first]
+        self.count = self.limit
+
+    def startOf(self, index):
+        pos = self.position(index)
+        if pos >= 0:
+            return int(self._bounds[pos])
+
+    def endOf(self, index):
+        pos = self.position(index)
+        if pos >= 0:
+            return int(self._bounds[pos + 1])
+
+    def startTime(self, index):
+        pos = self.position(index)
+        if pos >= 0 and self._starts[pos] >= 0:
+            return int(self._starts[pos])
+
+    def positionAt(self, msecs):
+        # position of the segment playing at msecs from the playlist start,
+        # -1 if before the first one
+        return int(np.searchsorted(self.bounds[:-1], msecs, side='right')) - 1
+
+
+def adtsFrames(data):
+    # yields (offset, length, blocks) for each ADTS frame, skipping the ID3
+    # tag that HLS puts at the beginning of each segment
+    pos = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        pos = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 |
+            (data[8] & 0x7f) << 7 | (data[9] & 0x7f))
+        if data[5] & 0x10:
+            # footer
+            pos += 10
+    dataLen = len(data)
+    while pos + 7 <= dataLen:
+        if data[pos] != 0xff or data[pos + 1] & 0xf6 != 0xf0:
+            pos = data.find(b'\xff', pos + 1)
+            if pos < 0:
+                break
+            continue
+        length = (data[pos + 3] & 0x03) << 11 | data[pos + 4] << 3 | data[pos + 5] >> 5
+        if length < 7:
+            pos += 1
+            continue
+        yield pos, length, (data[pos + 6] & 0x03) + 1
+        pos += length
+
+
+def decodeSegment(path, previousPath=None):
+    # Segments are cut from a continuous AAC stream, so decoding one on its own
+    # gives a click at the boundary, as the decoder has no overlap data for
+    # the first frame. Instead of decoding the previous segment again, just
+    # prepend its last ADTS frames (the decoder only needs the previous frame)
+    # and drop the samples they produce.
+    preroll = b''
+    skip = 0
+    if previousPath:
+        with open(previousPath, 'rb') as f:
+            previous = f.read()
+        frames = list(adtsFrames(previous))[-PrerollFrames:]
+        if frames:
+            preroll = previous[frames[0][0]:]
+            skip = sum(blocks for _, _, blocks in frames) * AdtsFrameSamples
+    with open(path, 'rb') as f:
+        data = f.read()
+    segment = pydub.AudioSegment.from_file(BytesIO(preroll + data))
+    if segment.sample_width != 2:
+        segment = segment.set_sample_width(2)
+    # samples are already interleaved, which is what PyAudio wants: just
+    # view them as frames, without copying
+    samples = np.frombuffer(segment.raw_data, dtype=np.int16)
+    return DecodedSegment(samples.reshape(-1, segment.channels)[skip:], segment.frame_rate)
+
+
+class PcmCache(object):
+    # Decoded segments are stored as raw interleaved int16 frames in a "pcm"
+    # subdirectory of each radio cache, so that a segment that has already
+    # been played can be memory mapped back without running ffmpeg again.
+    # The cache has its own size limit, and the least recently used files are
+    # removed first (the access order is kept using the file mtime).
+    # File names also contain the sample rate and the channel count
+    # ("index-rate-channels.pcm"), since raw files have no header.
+
+    def __init__(self, cacheDirs, sizeLimit):
+        self.sizeLimit = sizeLimit
+        # segments are stored from the decoder threads
+        self.lock = threading.RLock()
+        self.dirs = []
+        self.entries = OrderedDict()
+        self.totalSize = 0
+        for radio, cacheDir in enumerate(cacheDirs):
+            pcmDir = checkDir('pcm', cacheDir)
+            self.dirs.append(pcmDir)
+            if not pcmDir:
+                continue
+            for fileInfo in pcmDir.entryInfoList(['*.pcm'], QtCore.QDir.Files,
+                QtCore.QDir.Time | QtCore.QDir.Reversed):
+                    try:
+                        index, rate, channels = map(int, fileInfo.completeBaseName().split('-'))
+                    except ValueError:
+                        # unknown file or old format without rate/channels
+                        pcmDir.remove(fileInfo.fileName())
+                        continue
+                    self.entries[(radio, index)] = fileInfo.size(), rate, channels
+                    self.totalSize += fileInfo.size()
+        self.evict()
+
+    def path(self, radio, index, rate, channels):
+        return self.dirs[radio].absoluteFilePath('{}-{}-{}.pcm'.format(index, rate, channels))
+
+    def load(self, radio, index):
+        key = radio, index
+        with self.lock:
+            if not key in self.entries:
+                return
+            size, rate, channels = self.entries[key]
+            path = self.path(radio, index, rate, channels)
+            try:
+                # copy-on-write mapping: in memory changes never reach the file
+                data = np.memmap(path, dtype=np.int16, mode='c')
+                os.utime(path)
+            except Exception as e:
+                print('pcm cache file {} not readable: {}'.format(path, e))
+                self.remove(radio, index)
+                return
+            self.entries.move_to_end(key)
+        return DecodedSegment(data.reshape(-1, channels), rate)
+
+    def store(self, radio, index, segment):
+        if not self.sizeLimit or not self.dirs[radio]:
+            return
+        data = np.ascontiguousarray(segment.data, dtype=np.int16)
+        rate, channels = segment.rate, data.shape[1]
+        path = self.path(radio, index, rate, channels)
+        key = radio, index
+        # a previous version might have a different format
+        self.remove(radio, index)
+        try:
+            data.tofile(path + '.part')
+            os.replace(path + '.part', path)
+        except Exception as e:
+            print('cannot write pcm cache file {}: {}'.format(path, e))
+            return
+        with self.lock:
+            self.totalSize += data.nbytes
+            self.entries[key] = data.nbytes, rate, channels
+            self.evict()
+
+    def remove(self, radio, index):
+        with self.lock:
+            entry = self.entries.pop((radio, index), None)
+            if entry is None:
+                return
+            size, rate, channels = entry
+            self.totalSize -= size
+            try:
+                os.remove(self.path(radio, index, rate, channels))
+            except OSError:
+                pass
+
+    def evict(self):
+        with self.lock:
+            while self.entries and self.totalSize > self.sizeLimit:
+                radio, index = next(iter(self.entries))
+                self.remove(radio, index)
+
+
+class CacheIndex(object):
+    # Persistent index of the segment cache, stored as an sqlite database in
+    # the parent of the radio cache directories: at startup the contents of
+    # the cache are read from here, without listing the directories.
+    # Changes are committed in batches, a couple of seconds later.
+    def __init__(self, path):
+        try:
+            self.db = sqlite3.connect(path)
+            self.createTable()
+        except Exception as e:
+            print('cannot open cache index {}: {}'.format(path, e))
+            self.db = sqlite3.connect(':memory:')
+            self.createTable()
+        self.commitTimer = QtCore.QTimer(singleShot=True, interval=2000, timeout=self.commit)
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.commit)
+
+    def createTable(self):
+        # name is the file name on the server, file the path in the cache
+        # directory; duration and start are in milliseconds (-1 if unknown)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS segments (
+            radio INTEGER, idx INTEGER, name TEXT, file TEXT, size INTEGER, 
+            duration INTEGER, start INTEGER, lastAccess INTEGER, checksum TEXT, 
+            PRIMARY KEY (radio, idx))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS segmentFiles ON segments (radio, file)')
+
+    def segments(self):
+        return self.db.execute('''SELECT radio, idx, name, file, size, duration, 
+            start, lastAccess FROM segments ORDER BY lastAccess''').fetchall()
+
+    def add(self, radio, index, name, entry, duration=-1, start=-1, checksum=''):
+        self.db.execute('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', 
+            (radio, index, name, entry.file, entry.size, duration, start, entry.lastAccess, checksum))
+        self.commitTimer.start()
+
+    def remove(self, radio, index):
+        self.db.execute('DELETE FROM segments WHERE radio = ? AND idx = ?', (radio, index))
+        self.commitTimer.start()
+
+    def touch(self, radio, index, lastAccess):
+        self.db.execute('UPDATE segments SET lastAccess = ? WHERE radio = ? AND idx = ?', 
+            (lastAccess, radio, index))
+        self.commitTimer.start()
+
+    def isUsed(self, radio, fileName):
+        return self.db.execute('SELECT 1 FROM segments WHERE radio = ? AND file = ? LIMIT 1', 
+            (radio, fileName)).fetchone() is not None
+
+    def commit(self):
+        self.commitTimer.stop()
+        try:
+            self.db.commit()
+        except Exception as e:
+            print('cannot write cache index: {}'.format(e))
+
+
+def shardPath(checksum):
+    # segments are stored by content, in subdirectories named after the
+    # first two digits of their checksum
+    return '{}/{}.aac'.format(checksum[:2], checksum)
+
+
+class MemoryPcmCache(object):
+    # Least recently used decoded segments, kept in memory in front of the
+    # pcm cache: live playback and short rewinds don't need to read anything
+    # from disk.
+    def __init__(self, sizeLimit):
+        self.sizeLimit = sizeLimit
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.totalSize = 0
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return '{} segments, {:.1f}MB, {} hits, {} misses'.format(
+            len(self.entries), self.totalSize / 1048576, self.hits, self.misses)
+
+    def get(self, radio, index):
+        key = radio, index
+        with self.lock:
+            segment = self.entries.get(key)
+            if segment is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return segment
+
+    def put(self, radio, index, segment):
+        if segment.data.nbytes > self.sizeLimit:
+            return
+        key = radio, index
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.totalSize -= previous.data.nbytes
+            self.entries[key] = segment
+            self.totalSize += segment.data.nbytes
+            while self.totalSize > self.sizeLimit:
+                self.totalSize -= self.entries.popitem(last=False)[1].data.nbytes
+
+    def remove(self, radio, index):
+        with self.lock:
+            segment = self.entries.pop((radio, index), None)
+            if segment is not None:
+                self.totalSize -= segment.data.nbytes
+
+
+class DecodeWorker(QtCore.QRunnable):
+    def __init__(self, decoder, radio, index, path, previousPath):
+        super().__init__()
+        self.decoder = decoder
+        self.radio = radio
+        self.index = index
+        self.path = path
+        self.previousPath = previousPath
 
-    def read(self):
-        data = self.first.read()
-        if self.second:
-            data += self.second.read()
-        return data
+    def run(self):
+        try:
+            data = decodeSegment(self.path, self.previousPath)
+        except Exception as e:
+            print('error decoding index {}: {}'.format(self.index, e))
+            data = None
+        self.decoder.workerDone(self.radio, self.index, data)
 
-    def close(self):
-        self.first.close()
-        if self.second:
-            self.second.close()
 
+class Decoder(QtCore.QObject):
+    # Decodes segments in a thread pool, so that neither the GUI thread nor
+    # the audio callback ever wait for ffmpeg; the callback only takes the
+    # arrays that are already available.
+    segmentDecoded = QtCore.pyqtSignal(int, int)
+    decodeFailed = QtCore.pyqtSignal(int, int)
 
-class MultiReader:
-    def __init__(self, first, second=None):
-        self.reader = MultiFileObject(first, second)
+    def __init__(self, parent, cache, gapless=True):
+        super().__init__(parent)
+        self.cache = cache
+        self.gapless = gapless
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.ready = {}
+        self.pending = set()
+        self.waiting = set()
+        self.cache.segmentDownloaded.connect(self.segmentDownloaded)
+        self.cache.playlistReceived.connect(self.playlistReceived)
+        self.decodeFailed.connect(self.retryMissing)
+
+    def request(self, radio, index):
+        key = radio, index
+        if key in self.ready or key in self.pending:
+            return
+        data = self.cache.loadPcm(radio, index)
+        if data is not None:
+            self.ready[key] = data
+            self.segmentDecoded.emit(radio, index)
+            return
+        if not self.cache.indexFileExists(radio, index):
+            # the read ahead downloads it, decoding will start as soon as
+            # the file is in the cache
+            self.waiting.add(key)
+            if not index in self.cache.indexToFile[radio]:
+                self.cache.downloadPlaylist(radio)
+            else:
+                self.cache.scheduleReadAhead()
+            return
+        previousPath = None
+        if self.gapless:
+            if self.cache.indexFileExists(radio, index - 1):
+                previousPath = self.cache.getPathFromIndex(radio, index - 1)
+            elif index - 1 in self.cache.indexToFile[radio]:
+                # without the previous segment as preroll the decoded data
+                # would start with a gap, and it would be cached that way
+                self.waiting.add(key)
+                return
+        self.waiting.discard(key)
+        self.pending.add(key)
+        self.pool.start(DecodeWorker(self, radio, index,
+            self.cache.getPathFromIndex(radio, index), previousPath))
+
+    def segmentDownloaded(self, radio, index):
+        # the next segment might be waiting for this one as preroll
+        for key in ((radio, index), (radio, index + 1)):
+            if key in self.waiting:
+                self.request(*key)
+
+    def playlistReceived(self, radio):
+        # requested indexes might not have been in the playlist yet
+        for key in sorted(self.waiting):
+            if key[0] == radio:
+                self.request(*key)
+
+    def workerDone(self, radio, index, data):
+        # called from the worker thread
+        key = radio, index
+        if data is not None and key in self.pending:
+            self.cache.storePcm(radio, index, data)
+            self.ready[key] = data
+            self.segmentDecoded.emit(radio, index)
+        self.pending.discard(key)
+        if data is None:
+            self.decodeFailed.emit(radio, index)
+
+    def retryMissing(self, radio, index):
+        # if the files were deleted from the cache, download them again
+        missing = [self.cache.dropMissingFile(radio, i) for i in (index, index - 1)]
+        if any(missing):
+            self.request(radio, index)
+
+    def peek(self, radio, index):
+        return self.ready.get((radio, index))
+
+    def take(self, radio, index):
+        return self.ready.pop((radio, index), None)
+
+    def discard(self, radio, firstIndex):
+        # forget everything that is not going to be played anymore
+        for key in list(self.ready):
+            if key[0] != radio or key[1] < firstIndex:
+                self.ready.pop(key, None)
+        self.waiting = set(k for k in self.waiting if k[0] == radio and k[1] >= firstIndex)
+
+    def clear(self):
+        self.ready.clear()
+        self.waiting.clear()
+        self.pending.clear()
+
+
+class RingBuffer(object):
+    # Preallocated single producer/single consumer ring of int16 frames.
+    # The positions are absolute frame counters: the producer only moves
+    # writePos, the consumer only moves readPos, and each one updates its
+    # counter only after the copy is done, so no lock is needed.
+    def __init__(self, frames, channels=2):
+        self.size = frames
+        self.buffer = np.zeros((frames, channels), dtype=np.int16)
+        self.readPos = self.writePos = 0
+
+    def available(self):
+        return self.writePos - self.readPos
+
+    def space(self):
+        return self.size - (self.writePos - self.readPos)
+
+    def write(self, data):
+        count = min(len(data), self.space())
+        start = self.writePos % self.size
+        first = min(count, self.size - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:count - first] = data[first:count]
+        self.writePos += count
+        return count
+
+    def read(self, out):
+        count = min(len(out), self.writePos - self.readPos)
+        start = self.readPos % self.size
+        first = min(count, self.size - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:count] = self.buffer[:count - first]
+        self.readPos += count
+        return count
+
+
+class GainStage(object):
+    # Applies the volume in place on the output buffer, using preallocated
+    # float32 buffers and saturating to int16. Nothing is done at unity gain,
+    # and gain changes are faded linearly along one block to avoid clicks.
+    def __init__(self, frames=4096, channels=2):
+        self.current = self.target = 1.
+        self.rampFrames = 0
+        self.allocate(frames, channels)
+
+    def allocate(self, frames, channels):
+        self.work = np.zeros((frames, channels), dtype=np.float32)
+        self.ramp = np.zeros((frames, 1), dtype=np.float32)
+        self.unitRamp = np.zeros((frames, 1), dtype=np.float32)
+
+    def setGain(self, gain):
+        self.target = gain
+
+    def process(self, data):
+        target = self.target
+        current = self.current
+        if current == target == 1:
+            return
+        frames, channels = data.shape
+        if frames > len(self.work) or channels != self.work.shape[1]:
+            self.allocate(frames, channels)
+            self.rampFrames = 0
+        work = self.work[:frames]
+        if current == target:
+            np.multiply(data, np.float32(target), out=work)
+        else:
+            if frames != self.rampFrames:
+                self.rampFrames = frames
+                self.unitRamp[:frames, 0] = np.arange(1, frames + 1) / frames
+            ramp = self.ramp[:frames]
+            np.multiply(self.unitRamp[:frames], np.float32(target - current), out=ramp)
+            ramp += np.float32(current)
+            np.multiply(data, ramp, out=work)
+            self.current = target
+        np.clip(work, -32768, 32767, out=work)
+        np.copyto(data, work, casting='unsafe')
+
+
+class RingFeeder(threading.Thread):
+    # Producer side of the ring buffer: takes the decoded segments from the
+    # decoder and copies them to the ring as soon as there is space.
+    # Segment boundaries are stored as (writePos, index), so that the
+    # consumer knows which index is playing.
+    # If the next segment has a different format the feeder stops there and
+    # sets formatChanged: the stream has to be opened again.
+    def __init__(self, ring, decoder, radio, index, segment):
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.decoder = decoder
+        self.radio = radio
+        self.index = index
+        self.format = segment.rate, segment.data.shape[1]
+        self.formatChanged = False
+        self.data = segment.data
+        self.boundaries = deque([(ring.writePos, index)])
+        # prefill, so that the stream can be started right away
+        self.pos = ring.write(self.data)
+        self.running = True
+        self.wake = threading.Event()
+
+    def run(self):
+        ring = self.ring
+        while self.running:
+            if self.data is None:
+                segment = self.decoder.peek(self.radio, self.index + 1)
+                if segment is None or self.formatChanged:
+                    self.wait()
+                    continue
+                if (segment.rate, segment.data.shape[1]) != self.format:
+                    self.formatChanged = True
+                    continue
+                data = self.decoder.take(self.radio, self.index + 1).data
+                self.index += 1
+                self.data = data
+                self.pos = 0
+                self.boundaries.append((ring.writePos, self.index))
+            self.pos += ring.write(self.data[self.pos:])
+            if self.pos >= len(self.data):
+                self.data = None
+            else:
+                self.wait()
 
-    def __enter__(self):
-        return self.reader
+    def wait(self):
+        self.wake.wait(.02)
+        self.wake.clear()
 
-    def __exit__(self, type, value, traceback):
-        self.reader.close()
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.join()
 
 
 class AudioPlayer(QtCore.QObject):
@@ -208,6 +898,8 @@ class AudioPlayer(QtCore.QObject):
     SuspendedState, StoppedState, ActiveState = range(-2, 1)
     currentStateChanged = QtCore.pyqtSignal(int)
     currentIndexChanged = QtCore.pyqtSignal(int)
+    # emitted from the audio thread, the connection is always queued
+    restartRequested = QtCore.pyqtSignal(int)
 #    request = QtCore.pyqtSignal(int)
 
     def __init__(self, parent):
@@ -215,10 +907,27 @@ class AudioPlayer(QtCore.QObject):
         self.cache = parent.cache
         self.pyaudio = pyaudio.PyAudio()
         self.stream = None
-        self.nextData = None
+        self.radio = None
+        self.streamProfile = None
+        # (rate, channels) of the open stream, taken from the decoded audio
+        self.format = None
+        self.feeder = None
+        self.ring = None
+        self.output = np.zeros((4096, 2), dtype=np.int16)
+        self.gain = GainStage()
+        self.bytePos = 0
+        self.restarting = False
+        # blocks played with missing audio; the callback only counts them
+        self.underruns = 0
         self._currentIndex = -1
         self._currentState = self.StoppedState
         self._volume = 1
+        self.gapless = QtCore.QSettings().value('gaplessChaining', True, type=bool)
+        self.setLatencyProfile(QtCore.QSettings().value('latencyProfile', 1, type=int))
+        self.decoder = Decoder(self, self.cache, self.gapless)
+        self.decoder.segmentDecoded.connect(self.wakeFeeder)
+        self.currentIndexChanged.connect(self.prefetch)
+        self.restartRequested.connect(self.start)
 #        self.curve = QtCore.QEasingCurve(QtCore.QEasingCurve.InCubic)
 
     @property
@@ -248,37 +957,96 @@ class AudioPlayer(QtCore.QObject):
 #        self._volume = self.curve.valueForProgress(volume)
 #        self._volume = sin(radians(90 * volume))
         self._volume = pow(2.0, (sqrt(sqrt(sqrt(volume))) * 192 - 192.)/6.0)
+        self.gain.setGain(self._volume)
 #        self._volume = 1 - sqrt(1 - volume ** 2)
 
+    def setLatencyProfile(self, profile):
+        # the stream and the ring are recreated on the next start
+        profile = max(0, min(profile, len(LatencyProfiles) - 1))
+        self.latencyProfile = profile
+        self.framesPerBuffer, self.ringSeconds, self.decodeAhead = LatencyProfiles[profile]
+        if self.currentState == self.StoppedState:
+            self.closeStream()
+
+    def openStream(self, rate, channels):
+        if (self.stream and self.streamProfile == self.latencyProfile and 
+            self.format == (rate, channels)):
+                return
+        self.closeStream()
+        # PyAudio does not allow to set the suggested latency, the ring
+        # buffer size is what gives the actual resistance to dropouts
+        self.stream = self.pyaudio.open(
+            format=pyaudio.paInt16, channels=channels, rate=rate, 
+            frames_per_buffer=self.framesPerBuffer, 
+            start=False, output=True, 
+            stream_callback=self.readData)
+        self.streamProfile = self.latencyProfile
+        self.format = rate, channels
+        ringFrames = self.msecsToFrames(self.ringSeconds * 1000)
+        if not self.ring or self.ring.buffer.shape != (ringFrames, channels):
+            self.ring = RingBuffer(ringFrames, channels)
+        if self.output.shape[0] < self.framesPerBuffer or self.output.shape[1] != channels:
+            self.output = np.zeros((max(self.framesPerBuffer, 4096), channels), dtype=np.int16)
+
+    def framesToMSecs(self, frames):
+        if not self.format:
+            return 0
+        return frames * 1000 / self.format[0]
+
+    def msecsToFrames(self, msecs):
+        return int(msecs * self.format[0] / 1000)
+
+    def closeStream(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
     def setFileNameTemplate(self, pre, post):
         self.pre = pre
         self.post = post
 
     def setRadio(self, radio):
+        if radio != self.radio:
+            self.decoder.clear()
         self.radio = radio
 #        self.pathDir = self.parent().cacheDirs[radio]
 
     def start(self, index, radio=None):
         print('starting from {}?!'.format(index))
-        if not self.stream:
-            self.stream = self.pyaudio.open(
-                format=8, channels=2, rate=44100, 
-                start=False, output=True, 
-                stream_callback=self.readData)
-
-        if self.currentState == self.SuspendedState and index == self.currentIndex:
-            self.stream.start_stream()
-            self.currentState = self.ActiveState
+        if (self.currentState == self.SuspendedState and index == self.currentIndex and 
+            self.stream):
+                self.stream.start_stream()
+                self.currentState = self.ActiveState
         else:
+            if self.stream and self.stream.is_active():
+                self.stream.stop_stream()
+            self.stopFeeder()
+            segment = self.getData(index, radio)
+            self.openStream(segment.rate, segment.data.shape[1])
+            # the ring is empty, positions can be safely reset
+            self.ring.readPos = self.ring.writePos = 0
+            self.restarting = False
+            self.feeder = RingFeeder(self.ring, self.decoder, self.radio, index, segment)
+            self.feeder.start()
             self.currentIndex = index
-            self.currentData = self.getData(index, radio)
 
             self.bytePos = 0
             self.stream.start_stream()
             self.currentState = self.ActiveState
 #            self.request.emit(index + 1)
-            self.overlapping = False
-        self.cache.fetchIndex(self.radio, index + 1)
+        self.prefetch()
+
+    def prefetch(self):
+        if self.currentState == self.StoppedState or not self.feeder:
+            return
+        # the feeder is usually ahead of the playing index
+        index = max(self.currentIndex, self.feeder.index)
+        # the segments decoded in advance are downloaded by the read ahead
+        self.cache.setReadAhead(self.radio, self.currentIndex, 
+            index - self.currentIndex + self.decodeAhead)
+        self.decoder.discard(self.radio, index + 1)
+        for nextIndex in range(index + 1, index + 1 + self.decodeAhead):
+            self.decoder.request(self.radio, nextIndex)
 
     def pause(self):
         if self.stream:
@@ -294,79 +1062,69 @@ class AudioPlayer(QtCore.QObject):
         if self.stream:
             self.stream.stop_stream()
             self.currentState = self.StoppedState
-            self.currentData = self.nextData = None
-            self.overlapping = False
+            self.stopFeeder()
+            self.decoder.clear()
+            self.cache.cancelReadAhead()
+            if self.streamProfile != self.latencyProfile:
+                self.closeStream()
+
+    def stopFeeder(self):
+        if self.feeder:
+            self.feeder.stop()
+            self.feeder = None
+            # the stream is stopped, drop whatever is left
+            self.ring.readPos = self.ring.writePos
+
+    def wakeFeeder(self):
+        if self.feeder:
+            self.feeder.wake.set()
 
     def getData(self, index, radio=None):
         if radio is not None:
             self.setRadio(radio)
+        segment = self.decoder.take(self.radio, index)
+        if segment is not None:
+            return segment
+        segment = self.cache.loadPcm(self.radio, index)
+        if segment is not None:
+            return segment
 #        segment = pydub.AudioSegment.from_file('{}/{}{}{}'.format(
 #            self.path, self.pre, index, self.post))
-        segment = pydub.AudioSegment.from_file(self.cache.getPathFromIndex(self.radio, index))
-        data = segment.get_array_of_samples()
-        array = np.array(data).reshape(2, -1, order='F').swapaxes(1, 0)
-        return array
-
-    def getNextData(self):
-#        currentFile = '{}/{}{}{}'.format(
-#            self.path, self.pre, self.currentIndex, self.post)
-#        nextFile = '{}/{}{}{}'.format(
-#            self.path, self.pre, self.currentIndex + 1, self.post)
-        currentFile = self.cache.getPathFromIndex(self.radio, self.currentIndex)
-        nextFile = self.cache.getPathFromIndex(self.radio, self.currentIndex + 1)
-        if nextFile is None:
-            self.cache.fetchIndex(self.radio, self.currentIndex + 1)
-            QtCore.QTimer.singleShot(100, self.getNextData)
-            print('next index {} does not exist yet, retry in a bit...'.format(self.currentIndex + 1))
-            return
-        print('muxing?', currentFile, nextFile)
-        with MultiReader(currentFile, nextFile) as f:
-            segment = pydub.AudioSegment.from_file(f)
-        data = segment.get_array_of_samples()
-        print('caricato', segment.frame_count(), len(data), len(np.array(data)))
-        self.nextData = np.array(data).reshape(2, -1, order='F').swapaxes(1, 0)[len(self.currentData):]
-        self.overlapping = False
+        previousFile = None
+        if self.gapless and self.cache.indexFileExists(self.radio, index - 1):
+            previousFile = self.cache.getPathFromIndex(self.radio, index - 1)
+        segment = decodeSegment(self.cache.getPathFromIndex(self.radio, index), previousFile)
+        # a decode without preroll starts with a gap, it is not cached
+        if previousFile or not self.gapless or not index - 1 in self.cache.indexToFile[self.radio]:
+            self.cache.storePcm(self.radio, index, segment)
+        return segment
 
     def readData(self, _, frameCount, timeInfo, status):
-        data = self.currentData[self.bytePos:self.bytePos + frameCount]
-#        if not len(data):
-#            print('no data!')
-#            self.currentState = self.StoppedState
-#            return None, pyaudio.paComplete
-        dataLen = len(data)
-        if dataLen < frameCount and not self.overlapping:
-            print('troppo corto, accodo prossimo chunk', self.currentIndex + 1, self.bytePos)
-            diff = frameCount - dataLen
-            self.bytePos = diff
-            self.currentIndex += 1
-            self.currentData = self.nextData
-            self.nextData = None
-            data = np.concatenate((data, self.currentData[:diff]))
-            print('diff', diff)
-#            print(self.bytePos, len(self.currentData), self.currentIndex)
-            if not len(data):
-                print('no data!')
-                self.currentState = self.StoppedState
-                return None, pyaudio.paComplete
-#            QtCore.QTimer.singleShot(8000, lambda i=self.currentIndex + 1: self.cache.fetchIndex(i))
-#            self.request.emit(self.currentIndex + 1)
-        else:
-            self.bytePos += frameCount
-            if self.bytePos + frameCount * 100 > len(self.currentData) and self.nextData is None and not self.overlapping:
-                self.overlapping = True
-                print('overlapping!!!\n')
-                QtCore.QTimer.singleShot(0, self.getNextData)
-#                nextData = self.getData(self.currentIndex + 1)
-#                self.currentData[-1024:] += nextData[:1024]
-#                print('done', len(self.currentData))
-#                self.nextData = nextData[1024:]
-#            if self.bytePos + frameCount * 10 > len(self.currentData):
-#                print('sto per cambiare')
-#                newData = self.getData(self.currentIndex + 1)
-#                print('ok!', len(self.currentData), len(newData), type(self.currentData), type(newData))
-#                self.currentData = np.concatenate((self.currentData, newData))
-        data *= self._volume
-        return data.tostring(), pyaudio.paContinue
+        # everything happens on preallocated buffers: the only copy is from
+        # the ring to the output buffer, which is returned as it is (PyAudio
+        # copies it to the device buffer)
+        if frameCount > len(self.output):
+            self.output = np.zeros((frameCount, self.format[1]), dtype=np.int16)
+        data = self.output[:frameCount]
+        count = self.ring.read(data)
+        if count < frameCount:
+            data[count:] = 0
+            if self.feeder.formatChanged:
+                # everything in the old format has been played
+                if not self.restarting:
+                    self.restarting = True
+                    self.restartRequested.emit(self.feeder.index + 1)
+            else:
+                self.underruns += 1
+        readPos = self.ring.readPos
+        boundaries = self.feeder.boundaries
+        while len(boundaries) > 1 and boundaries[1][0] <= readPos:
+            boundaries.popleft()
+        start, index = boundaries[0]
+        self.bytePos = readPos - start
+        self.currentIndex = index
+        self.gain.process(data)
+        return data, pyaudio.paContinue
 #            self.notify.emit((currentTime() - self.currentTime).total_seconds())
 #        try:
 #            self.waveIODevice.stop()
@@ -781,24 +1539,23 @@ class SeekSlider(QtWidgets.QWidget):
         qp = QtGui.QPainter(self)
 #        print(self.parent(), self.window().timeStamps)
 
-        timeStamps = self.window().timeStamps[self.window().lastRadio]
         grooveSize = (self.maxTick - self.minTick) / 2160
-        if timeStamps:
-            cacheData = self.window().cache[self.window().lastRadio]
-            cacheRect = QtCore.QRectF(0, 0, grooveSize, self.topMargin)
+        cache = self.window().cache
+        radio = self.window().lastRadio
+        indexes = cache.indexToFile[radio].indexes[-2160:] if radio >= 0 else []
+        if len(indexes):
+            # the last segment is at the right end, draw a rectangle for
+            # each range of cached segments
+            cached = np.concatenate(([False], cache.residentMask(radio, indexes), [False]))
+            changes = np.flatnonzero(cached[1:] != cached[:-1])
+            left = self.maxTick - len(indexes) * grooveSize
             qp.save()
             qp.setRenderHints(qp.Antialiasing)
             qp.setPen(QtCore.Qt.NoPen)
             qp.setBrush(self.cacheBackground)
-            qp.translate(self.maxTick - grooveSize, 0)
-            c = 0
-            for length, index in reversed(timeStamps):
-                if index in cacheData:
-                    qp.drawRect(cacheRect)
-                qp.translate(-grooveSize, 0)
-                c += 1
-                if c > 2160:
-                    break
+            for start, end in zip(changes[::2].tolist(), changes[1::2].tolist()):
+                qp.drawRect(QtCore.QRectF(left + start * grooveSize, 0, 
+                    (end - start) * grooveSize, self.topMargin))
             qp.restore()
 
         if self._recStart >= 0:
@@ -886,11 +1643,94 @@ class DurationDelegate(QtWidgets.QStyledItemDelegate):
         return '{:02}:{:02}"'.format(mins, secs)
 
 
+def parseRecordFileName(fileName):
+    # "radio-start-end-name.aac", raises an exception for unknown names
+    splitted = fileName.split('-')
+    assert len(splitted) >= 4
+    radio = RadioNames.index(splitted[0].lower())
+    start = QtCore.QDateTime.fromString(splitted[1], 'yyyyMMddhhmmss')
+    end = QtCore.QDateTime.fromString(splitted[2], 'yyyyMMddhhmmss')
+    assert start.isValid() and end.isValid()
+    name = '-'.join(splitted[3:])
+    if name.endswith('.aac'):
+        name = name[:-len('.aac')]
+    return radio, start, end, name
+
+
+def scanAdts(path):
+    # returns the duration in milliseconds and the number of segments of a
+    # recording, following the ADTS frame headers without decoding; each
+    # segment begins with an ID3 tag
+    duration = 0
+    segments = 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        size = len(data)
+        pos = 0
+        while pos + 10 <= size:
+            if data[pos:pos + 3] == b'ID3':
+                # the tag size is "syncsafe", 7 bits per byte
+                tagSize = 0
+                for byte in data[pos + 6:pos + 10]:
+                    tagSize = (tagSize << 7) | (byte & 0x7f)
+                pos += 10 + tagSize
+                segments += 1
+                continue
+            if data[pos] != 0xff or data[pos + 1] & 0xf0 != 0xf0:
+                pos = data.find(b'\xff', pos + 1)
+                if pos < 0:
+                    break
+                continue
+            rateIndex = (data[pos + 2] >> 2) & 0xf
+            frameLength = ((data[pos + 3] & 3) << 11) | (data[pos + 4] << 3) | (data[pos + 5] >> 5)
+            if rateIndex >= len(AdtsSampleRates) or frameLength < 7:
+                pos += 1
+                continue
+            # each raw data block has 1024 samples
+            duration += ((data[pos + 6] & 3) + 1) * 1024000 / AdtsSampleRates[rateIndex]
+            pos += frameLength
+    return int(duration), segments
+
+
+class RecordScanWorker(QtCore.QRunnable):
+    def __init__(self, model, fileName, path):
+        super().__init__()
+        self.model = model
+        self.fileName = fileName
+        self.path = path
+
+    def run(self):
+        try:
+            duration, segments = scanAdts(self.path)
+        except Exception as e:
+            print('cannot scan recording {}: {}'.format(self.fileName, e))
+            duration = segments = -1
+        self.model.scanDone.emit(self.fileName, duration, segments)
+
+
 class RecordModel(QtGui.QStandardItemModel):
-    # will be SortFilterProxyModel from filesystem!
+    # The recordings directory is watched, and only the rows of files that
+    # have been added, changed or removed are updated. Real durations and
+    # segment counts are read from the files in a thread pool, and kept
+    # in a metadata file in the directory, by name, mtime and size.
+    scanDone = QtCore.pyqtSignal(str, int, int)
+
     def __init__(self, parent):
         super().__init__(parent)
-        self.setHorizontalHeaderLabels(['Network', 'Start', 'End', 'Duration'])
+        self.setHorizontalHeaderLabels(['Network', 'Start', 'End', 'Duration', 'Segments'])
+        # {file name: (mtime, size, record item)}
+        self.rows = {}
+        # {file name: [mtime, size, duration, segments]}
+        self.metadata = {}
+        self.metadataPath = None
+        # {file name: (mtime, size)} of the files being scanned
+        self.scanning = {}
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.scanDone.connect(self.recordingScanned)
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.updateTimer = QtCore.QTimer(singleShot=True, interval=500, timeout=self.getRecordings)
+        self.watcher.directoryChanged.connect(lambda path: self.updateTimer.start())
+        self.saveTimer = QtCore.QTimer(singleShot=True, interval=2000, timeout=self.saveMetadata)
 
         self.parentIndexes = []
 
@@ -907,49 +1747,120 @@ class RecordModel(QtGui.QStandardItemModel):
         self.appendRow(unknownItem)
         self.unknownItems = self.indexFromItem(unknownItem)
 
+    def loadMetadata(self, recordDir):
+        self.metadataPath = recordDir.absoluteFilePath('.recordings.json')
+        if not recordDir.absolutePath() in self.watcher.directories():
+            self.watcher.addPath(recordDir.absolutePath())
+        try:
+            with open(self.metadataPath) as f:
+                self.metadata = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('cannot read recordings metadata: {}'.format(e))
+
+    def saveMetadata(self):
+        if not self.metadataPath:
+            return
+        try:
+            with open(self.metadataPath + '.part', 'w') as f:
+                json.dump(self.metadata, f)
+            os.replace(self.metadataPath + '.part', self.metadataPath)
+        except Exception as e:
+            print('cannot write recordings metadata: {}'.format(e))
+
     def getRecordings(self):
-        for parent in self.parentIndexes + [self.unknownItems]:
-            if self.rowCount(parent):
-                self.removeRows(0, self.rowCount(parent), parent)
         recordDir = QtCore.QDir(self.parent().recordDir)
         if not recordDir.exists():
             return
+        if self.metadataPath is None:
+            self.loadMetadata(recordDir)
+        found = set()
         for fileInfo in recordDir.entryInfoList(['*.aac'], QtCore.QDir.Files):
             fileName = fileInfo.fileName()
             if not fileInfo.size():
                 continue
-            try:
-                splitted = fileInfo.fileName().split('-')
-                assert len(splitted) >= 4
-                parent = self.parentIndexes[RadioNames.index(splitted[0].lower())]
-                start = QtCore.QDateTime.fromString(splitted[1], 'yyyyMMddhhmmss')
-                end = QtCore.QDateTime.fromString(splitted[2], 'yyyyMMddhhmmss')
-                duration = start.secsTo(end)
-                name = '-'.join(splitted[3:])
-                if name.endswith('.aac'):
-                    name = name[:-len('.aac')]
-                valid = True
-            except:
-                parent = self.unknownItems
-                start = '?'
-                end = '?'
-                duration = '?'
-                name = fileName
-                valid = False
-            recordItem = QtGui.QStandardItem(name)
-            recordItem.setData(fileInfo, RecordFileRole)
-            startItem = QtGui.QStandardItem()
-            startItem.setData(start, QtCore.Qt.DisplayRole)
-            endItem = QtGui.QStandardItem()
-            endItem.setData(start, QtCore.Qt.DisplayRole)
-            durationItem = QtGui.QStandardItem()
-            durationItem.setData(duration, QtCore.Qt.DisplayRole)
-            durationItem.setTextAlignment(QtCore.Qt.AlignRight|QtCore.Qt.AlignVCenter)
-            items = [recordItem, startItem, endItem, durationItem]
-            self.itemFromIndex(parent).appendRow(items)
-            for item in items:
-                if item != recordItem or not valid:
-                    item.setFlags(parent.flags())
+            found.add(fileName)
+            mtime = fileInfo.lastModified().toMSecsSinceEpoch()
+            row = self.rows.get(fileName)
+            if row and row[:2] == (mtime, fileInfo.size()):
+                continue
+            if row:
+                self.removeRecording(fileName)
+            self.addRecording(fileInfo, mtime)
+        for fileName in set(self.rows) - found:
+            self.removeRecording(fileName)
+        if set(self.metadata) - found:
+            for fileName in set(self.metadata) - found:
+                del self.metadata[fileName]
+            self.saveTimer.start()
+
+    def addRecording(self, fileInfo, mtime):
+        fileName = fileInfo.fileName()
+        try:
+            radio, start, end, name = parseRecordFileName(fileName)
+            parent = self.parentIndexes[radio]
+            duration = start.secsTo(end)
+            valid = True
+        except:
+            parent = self.unknownItems
+            start = '?'
+            end = '?'
+            duration = '?'
+            name = fileName
+            valid = False
+        recordItem = QtGui.QStandardItem(name)
+        recordItem.setData(fileInfo, RecordFileRole)
+        startItem = QtGui.QStandardItem()
+        startItem.setData(start, QtCore.Qt.DisplayRole)
+        endItem = QtGui.QStandardItem()
+        endItem.setData(end, QtCore.Qt.DisplayRole)
+        durationItem = QtGui.QStandardItem()
+        durationItem.setData(duration, QtCore.Qt.DisplayRole)
+        durationItem.setTextAlignment(QtCore.Qt.AlignRight|QtCore.Qt.AlignVCenter)
+        segmentsItem = QtGui.QStandardItem()
+        segmentsItem.setTextAlignment(QtCore.Qt.AlignRight|QtCore.Qt.AlignVCenter)
+        items = [recordItem, startItem, endItem, durationItem, segmentsItem]
+        self.itemFromIndex(parent).appendRow(items)
+        for item in items:
+            if item != recordItem or not valid:
+                item.setFlags(parent.flags())
+        self.rows[fileName] = mtime, fileInfo.size(), recordItem
+
+        metadata = self.metadata.get(fileName)
+        if metadata and metadata[:2] == [mtime, fileInfo.size()]:
+            self.setRecordingInfo(recordItem, *metadata[2:])
+        elif not fileName in self.scanning:
+            self.scanning[fileName] = mtime, fileInfo.size()
+            self.pool.start(RecordScanWorker(self, fileName, fileInfo.absoluteFilePath()))
+
+    def removeRecording(self, fileName):
+        recordItem = self.rows.pop(fileName)[-1]
+        recordItem.parent().removeRow(recordItem.row())
+
+    def setRecordingInfo(self, recordItem, duration, segments):
+        parent = recordItem.parent()
+        if duration >= 0:
+            parent.child(recordItem.row(), 3).setData(round(duration / 1000), QtCore.Qt.DisplayRole)
+        if segments > 0:
+            parent.child(recordItem.row(), 4).setData(segments, QtCore.Qt.DisplayRole)
+
+    def recordingScanned(self, fileName, duration, segments):
+        scanned = self.scanning.pop(fileName, None)
+        row = self.rows.get(fileName)
+        if not row:
+            return
+        mtime, size, recordItem = row
+        if scanned != (mtime, size):
+            # the file has changed in the meantime, scan it again
+            self.scanning[fileName] = mtime, size
+            self.pool.start(RecordScanWorker(self, fileName, 
+                recordItem.data(RecordFileRole).absoluteFilePath()))
+            return
+        self.setRecordingInfo(recordItem, duration, segments)
+        if duration >= 0:
+            self.metadata[fileName] = [mtime, size, duration, segments]
+            self.saveTimer.start()
 
     def zgetRecordings(self):
         # clearing will clear the currentIndex, selection and other things...
@@ -1092,6 +2003,7 @@ class SettingsDialog(QtWidgets.QDialog):
 
         self.storeGeometryChk.setChecked(self.settings.value('storeGeometry', True, type=bool))
         self.askToQuitChk.setChecked(self.settings.value('askToQuit', True, type=bool))
+        self.latencyProfileCombo.setCurrentIndex(self.settings.value('latencyProfile', 1, type=int))
         if not super().exec_():
             return
 
@@ -1112,6 +2024,8 @@ class SettingsDialog(QtWidgets.QDialog):
         else:
             self.settings.remove('geometry')
         self.settings.setValue('askToQuit', self.askToQuitChk.isChecked())
+        self.settings.setValue('latencyProfile', self.latencyProfileCombo.currentIndex())
+        self.parent().player.setLatencyProfile(self.latencyProfileCombo.currentIndex())
 
 
 class NowPlaying(QtWidgets.QTextBrowser):
@@ -1177,6 +2091,45 @@ class RecordNameDialog(QtWidgets.QDialog):
         return self.nameInput.text()
 
 
+class ScheduleDialog(QtWidgets.QDialog):
+    def __init__(self, parent, radio=0):
+        super().__init__(parent)
+        self.setWindowTitle('Schedule recording')
+        layout = QtWidgets.QFormLayout(self)
+
+        self.radioCombo = QtWidgets.QComboBox()
+        self.radioCombo.addItems(RadioTitles)
+        self.radioCombo.setCurrentIndex(max(0, radio))
+        layout.addRow('Radio', self.radioCombo)
+
+        now = QtCore.QDateTime.currentDateTime()
+        self.startEdit = QtWidgets.QDateTimeEdit(now)
+        self.startEdit.setCalendarPopup(True)
+        # the playlist goes back six hours
+        self.startEdit.setMinimumDateTime(now.addSecs(-21600))
+        layout.addRow('Start', self.startEdit)
+        self.endEdit = QtWidgets.QDateTimeEdit(now.addSecs(3600))
+        self.endEdit.setCalendarPopup(True)
+        self.endEdit.setMinimumDateTime(now.addSecs(60))
+        layout.addRow('End', self.endEdit)
+        self.startEdit.dateTimeChanged.connect(
+            lambda dateTime: self.endEdit.setMinimumDateTime(dateTime.addSecs(60)))
+
+        self.nameInput = QtWidgets.QLineEdit('recording')
+        layout.addRow('Name', self.nameInput)
+
+        self.buttonBox = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Ok|QtWidgets.QDialogButtonBox.Cancel)
+        layout.addRow(self.buttonBox)
+        self.buttonBox.accepted.connect(self.accept)
+        self.buttonBox.rejected.connect(self.reject)
+
+    def exec_(self):
+        if super().exec_():
+            return (self.radioCombo.currentIndex(), self.startEdit.dateTime(), 
+                self.endEdit.dateTime(), self.nameInput.text())
+
+
 class Cache(QtCore.QObject):
     playlistReceived = QtCore.pyqtSignal(int)
     downloadStatusUpdate = QtCore.pyqtSignal(int, int, int)
@@ -1193,74 +2146,212 @@ class Cache(QtCore.QObject):
 
         self.settings = QtCore.QSettings()
         self.clearCacheTimer = QtCore.QTimer(singleShot=True, timeout=self.clearCache)
+        # size limit is in megabytes, as for cacheSizeLimit
+        self.pcmCache = PcmCache(self.cacheDirs,
+            self.settings.value('pcmCacheSizeLimit', 256, type=int) * 1048576)
+        self.memoryPcmCache = MemoryPcmCache(
+            self.settings.value('memoryCacheSizeLimit', 64, type=int) * 1048576)
 
         self.downloadQueue = {}
-        self.indexToFile = [{}, {}, {}]
+        # read ahead: segments following the play head are kept downloaded,
+        # with a limited number of concurrent downloads
+        self.readAheadRadio = None
+        self.readAheadIndex = -1
+        self.readAheadSize = self.settings.value('readAheadSegments', 4, type=int)
+        self.readAheadLength = self.readAheadSize
+        self.readAheadConcurrency = max(1, self.settings.value('readAheadConcurrency', 2, type=int))
+        self.readAheadJobs = set()
+        # segment downloads waiting to be started, as a heap of
+        # [priority, count, radio, index, kwargs] lists
+        self.downloadHeap = []
+        self.downloadCount = 0
+        self.queuedDownloads = {}
+        self.activeDownloads = {}
+        self.hostDownloads = {}
+        self.maxHostDownloads = max(1, self.settings.value('maxHostDownloads', 4, type=int))
+        # segments are written to hidden ".name.part" files while downloading
+        self.partFiles = {}
+        self.fsyncDownloads = self.settings.value('fsyncDownloads', False, type=bool)
+        for cacheDir in self.cacheDirs:
+            for fileInfo in cacheDir.entryInfoList(['.*.part'], QtCore.QDir.Files | QtCore.QDir.Hidden):
+                print('removing incomplete download {}'.format(fileInfo.fileName()))
+                cacheDir.remove(fileInfo.fileName())
+        # segment files in the cache of each radio, as {index: CacheEntry};
+        # they are read from the cache index, existence checks use these.
+        # cacheLru has the (radio, index) of all of them, in access order
+        self.resident = [{}, {}, {}]
+        self.cacheLru = OrderedDict()
+        self.cacheTotalSize = 0
+        # pinned ranges are never evicted, as {id: (radio, start, end)}
+        self.pins = {}
+        self.pinCount = 0
+        self.indexToFile = [SegmentIndex(), SegmentIndex(), SegmentIndex()]
+        self.cacheIndex = CacheIndex(os.path.join(os.path.dirname(
+            self.cacheDirs[0].absolutePath()), 'segments.sqlite'))
+        self.loadCacheIndex()
+        self.importLegacyFiles()
         self.timeStamps = [[], [], []]
         self.playlistActiveDownload = [False, False, False]
         self.playlistLoadingTime = [None, None, None]
-        self.isRecording = False
+        self.mediaSequence = [None, None, None]
+        # the first playlist of each radio is always parsed completely, as
+        # the contents restored from the cache index can have holes
+        self.playlistParsed = [False, False, False]
+        # (url, ETag, Last-Modified) of the last playlist reply
+        self.playlistValidators = [None, None, None]
+        # skip boundary in seconds, if the server supports delta updates
+        self.playlistCanSkip = [0, 0, 0]
         self.playlistCoolDownTimers = []
         for r in range(3):
             t = QtCore.QElapsedTimer()
             self.playlistCoolDownTimers.append(t)
             t.start()
 
+        self.playlistReceived.connect(lambda radio: self.scheduleReadAhead())
+
         self.clearCache()
 
+    def loadPcm(self, radio, index):
+        segment = self.memoryPcmCache.get(radio, index)
+        if segment is not None:
+            return segment
+        segment = self.pcmCache.load(radio, index)
+        if segment is not None:
+            # read the mapped file once, from now on it is in memory
+            segment = DecodedSegment(np.array(segment.data), segment.rate)
+            self.memoryPcmCache.put(radio, index, segment)
+        return segment
+
+    def storePcm(self, radio, index, segment):
+        self.memoryPcmCache.put(radio, index, segment)
+        self.pcmCache.store(radio, index, segment)
+
     def clearCache(self):
-        if self.isRecording:
-            self.clearCacheTimer.start(60000)
-            return
-        self.toRemove = 0
-        self.removed = 0
-        sizeLimit = self.settings.value('cacheSizeLimit', 0, type=int)
+        # incremental eviction, least recently used files first: files are
+        # removed if the whole cache is bigger than the size limit, or if
+        # they have not been used for longer than the time limit; only a few
+        # files are removed each time, and the timer restarts soon if more
+        # have to be removed
+        sizeLimit = self.settings.value('cacheSizeLimit', 0, type=int) * 1048576
         timeLimit = self.settings.value('cacheTimeLimit', 1, type=int)
-        remaining = 0
-        if sizeLimit:
-            # size limit is in megabytes!
-            sizeLimit *= 1048576
-            radioSizeLimit = sizeLimit // 3
-            totalSize = 0
-            for radio, cacheDir in enumerate(self.cacheDirs):
-                cacheDict = {f.file:i for i, f in self.indexToFile[radio].items()}
-                radioSize = 0
-                for fileInfo in cacheDir.entryInfoList(cacheDir.Files):
-                    size = fileInfo.size()
-                    radioSize += fileInfo.size()
-                    if radioSize > radioSizeLimit:
-                        self.toRemove += 1
-                        if cacheDir.remove(fileInfo.fileName()):
-                            try:
-                                cacheDict.pop(fileInfo.fileName())
-                            except:
-                                print('cache file "{}" not in contents'.format(fileInfo.fileName()))
-                            self.removed += 1
-                            continue
-                    totalSize += size
-            if totalSize:
-                # 10 seconds files are about 120000 bytes
-                # it should be // 120000, but we're using milliseconds
-                remaining = max(60000, (sizeLimit - totalSize) // 120)
-        if timeLimit:
-            # time limit is in hours!
-            remaining = timeLimit * 3600000
-            tooOld = QtCore.QDateTime.currentDateTime().addSecs(-timeLimit * 3600)
-            for radio, cacheDir in enumerate(self.cacheDirs):
-                cacheDict = {f.file:i for i, f in self.indexToFile[radio].items()}
-                for fileInfo in cacheDir.entryInfoList(cacheDir.Files):
-                    if fileInfo.lastModified() < tooOld:
-                        self.toRemove += 1
-                        if cacheDir.remove(fileInfo.fileName()):
-                            try:
-                                cacheDict.pop(fileInfo.fileName())
-                            except:
-                                print('cache file "{}" not in contents'.format(fileInfo.fileName()))
-                            self.removed += 1
-        if remaining:
-            self.clearCacheTimer.start(remaining)
-        if self.toRemove:
-            self.cacheCleared.emit(self.toRemove, self.removed)
+        tooOld = QtCore.QDateTime.currentMSecsSinceEpoch() - timeLimit * 3600000
+        toRemove = []
+        size = self.cacheTotalSize
+        for radio, index in self.cacheLru:
+            if len(toRemove) >= EvictionBatch:
+                break
+            entry = self.resident[radio][index]
+            if not (sizeLimit and size > sizeLimit or timeLimit and entry.lastAccess < tooOld):
+                # following files are newer
+                break
+            if self.isPinned(radio, index):
+                continue
+            toRemove.append((radio, index))
+            size -= entry.size
+        removed = 0
+        for radio, index in toRemove:
+            fileName = self.resident[radio][index].file
+            # forget it anyway, it will be downloaded again if required
+            self.removeResident(radio, index)
+            if self.cacheIndex.isUsed(radio, fileName):
+                # identical segments share the same file
+                continue
+            if self.cacheDirs[radio].remove(fileName):
+                removed += 1
+            else:
+                print('cannot remove cache file "{}"'.format(fileName))
+        if len(toRemove) >= EvictionBatch:
+            self.clearCacheTimer.start(100)
+        else:
+            self.clearCacheTimer.start(60000)
+        if toRemove:
+            self.cacheCleared.emit(len(toRemove), removed)
+
+    def loadCacheIndex(self):
+        # segments played in the last hours are also restored in the
+        # playlist contents, with their timing, when the first playlist
+        # arrives: until then, empty contents mean "no playlist yet"
+        minStart = QtCore.QDateTime.currentMSecsSinceEpoch() - 21600000
+        restored = self.restoredSegments = [[], [], []]
+        for radio, index, name, fileName, size, duration, start, lastAccess in self.cacheIndex.segments():
+            if radio >= len(self.cacheDirs):
+                continue
+            self.addResident(radio, index, CacheEntry(fileName, size, lastAccess), store=False)
+            if duration > 0 and start >= minStart:
+                restored[radio].append((index, name, duration, start))
+        for segments in restored:
+            segments.sort()
+
+    def importLegacyFiles(self):
+        # segments were previously stored with their server file name, in
+        # the radio cache directory
+        for radio, cacheDir in enumerate(self.cacheDirs):
+            for fileInfo in cacheDir.entryInfoList(cacheDir.Files):
+                found = FindIndexRegEx.findall(fileInfo.fileName())
+                if not found:
+                    continue
+                size = fileInfo.size()
+                lastAccess = fileInfo.lastModified().toMSecsSinceEpoch()
+                try:
+                    with open(fileInfo.absoluteFilePath(), 'rb') as source:
+                        checksum = hashlib.sha1(source.read()).hexdigest()
+                    fileName = shardPath(checksum)
+                    checkDir(checksum[:2], cacheDir)
+                    os.replace(fileInfo.absoluteFilePath(), cacheDir.absoluteFilePath(fileName))
+                except Exception as e:
+                    print('cannot import cache file {}: {}'.format(fileInfo.fileName(), e))
+                    continue
+                self.addResident(radio, int(found[-1]), CacheEntry(fileName, size, lastAccess), 
+                    fileInfo.fileName(), checksum=checksum)
+
+    def addResident(self, radio, index, entry, name=None, store=True, **kwargs):
+        self.removeResident(radio, index, store=False)
+        self.resident[radio][index] = entry
+        self.cacheLru[(radio, index)] = entry.size
+        self.cacheTotalSize += entry.size
+        if store:
+            self.cacheIndex.add(radio, index, name, entry, **kwargs)
+
+    def removeResident(self, radio, index, store=True):
+        entry = self.resident[radio].pop(index, None)
+        if entry:
+            self.cacheTotalSize -= self.cacheLru.pop((radio, index))
+            if store:
+                self.cacheIndex.remove(radio, index)
+
+    def dropMissingFile(self, radio, index):
+        # for files that cannot be read: if they are not on disk anymore
+        # they are forgotten, so that they will be downloaded again
+        entry = self.resident[radio].get(index)
+        if entry and not self.cacheDirs[radio].exists(entry.file):
+            print('cache file of index {} is missing'.format(index))
+            self.removeResident(radio, index)
+            return True
+        return False
+
+    def touchResident(self, radio, index):
+        entry = self.resident[radio].get(index)
+        if entry:
+            lastAccess = QtCore.QDateTime.currentMSecsSinceEpoch()
+            self.resident[radio][index] = entry._replace(lastAccess=lastAccess)
+            self.cacheLru.move_to_end((radio, index))
+            self.cacheIndex.touch(radio, index, lastAccess)
+
+    def pin(self, radio, start, end=None):
+        # protects indexes from start to end (included, or any following
+        # index if end is None) from eviction, returns the id for unpin()
+        self.pinCount += 1
+        self.pins[self.pinCount] = radio, start, end
+        return self.pinCount
+
+    def unpin(self, pinId):
+        self.pins.pop(pinId, None)
+
+    def isPinned(self, radio, index):
+        for pinRadio, start, end in self.pins.values():
+            if pinRadio == radio and start <= index and (end is None or index <= end):
+                return True
+        return False
 
 #    def getIndexFromTime(self, radio, time):
 #        contents = self.indexToFile[radio]
@@ -1287,36 +2378,57 @@ class Cache(QtCore.QObject):
 #        self.downloadPlaylist(radio)
 
     def getIndexFromTime(self, radio, time):
+        return self.getIndexesFromTimes(radio, [time])[0]
+#        return False
+
+    def getIndexesFromTimes(self, radio, times):
+        # resolves all times at once, returning a PlaylistResult for each
         contents = self.indexToFile[radio]
         if not contents:
             print('playlist empty!!!')
             self.downloadPlaylist(radio)
-            return PlaylistResult.Empty()
+            return [PlaylistResult.Empty() for time in times]
         now = QtCore.QDateTime.currentDateTime()
-        if isinstance(time, QtCore.QTime):
-            time = QtCore.QDateTime(QtCore.QDate.currentDate(), time)
-            if time > now:
-                time = time.addSecs(-86400)
-        if time > now:
-            print('time is in the future?!')
-            return PlaylistResult.Future()
         lastTime = self.playlistLoadingTime[radio]
         if lastTime.secsTo(now) > 60:
             print('playlist too old, redownloading')
             self.downloadPlaylist(radio)
-            return PlaylistResult.TooOld()
-        if lastTime.addSecs(-21600) > time:
-            print('time too old!')
-            return PlaylistResult.Past()
-        for index, info in sorted(contents.items(), key=lambda i: i[0], reverse=True)[:2160]:
-            lastTime = lastTime.addMSecs(-info.length)
-            if lastTime <= time:
-                info = self.indexToFile[radio].get(index)
-                if info:
-                    return PlaylistResult(index)
-        print('time does not exist!!!')
-        return PlaylistResult.DoesNotExist()
-#        return False
+            return [PlaylistResult.TooOld() for time in times]
+        today = QtCore.QDate.currentDate()
+        nowMSecs = now.toMSecsSinceEpoch()
+        timeMSecs = np.array([QtCore.QDateTime(today, time).toMSecsSinceEpoch() 
+            if isinstance(time, QtCore.QTime) else time.toMSecsSinceEpoch() 
+            for time in times], dtype=np.int64)
+        isTime = np.array([isinstance(time, QtCore.QTime) for time in times], dtype=bool)
+        # times without date are always in the last 24 hours
+        timeMSecs[isTime & (timeMSecs > nowMSecs)] -= 86400000
+
+        segmentIndex = self.indexToFile[radio]
+        lastMSecs = lastTime.toMSecsSinceEpoch()
+        positions = np.searchsorted(segmentIndex.starts, timeMSecs, side='right') - 1
+        indexes = segmentIndex.indexes
+        minPos = max(0, len(segmentIndex) - 2160)
+
+        results = []
+        for timeMSec, pos in zip(timeMSecs.tolist(), positions.tolist()):
+            if timeMSec > nowMSecs:
+                results.append(PlaylistResult.Future())
+            elif lastMSecs - 21600000 > timeMSec:
+                results.append(PlaylistResult.Past())
+            elif pos >= minPos:
+                results.append(PlaylistResult(int(indexes[pos])))
+            else:
+                results.append(PlaylistResult.DoesNotExist())
+        return results
+
+    def getTimeFromIndex(self, radio, index, end=False):
+        segmentIndex = self.indexToFile[radio]
+        msecs = segmentIndex.startTime(index)
+        if msecs is None:
+            return
+        if end:
+            msecs += segmentIndex.endOf(index) - segmentIndex.startOf(index)
+        return QtCore.QDateTime.fromMSecsSinceEpoch(msecs)
 
     def getIndexFromSliderPos(self, radio, pos):
         contents = self.indexToFile[radio]
@@ -1324,7 +2436,7 @@ class Cache(QtCore.QObject):
             print('playlist empty!!!')
             self.downloadPlaylist(radio)
             return PlaylistResult.Empty()
-        indexList = sorted(contents.keys())[-2161:]
+        indexList = self.indexToFile[radio].indexes[-2161:].tolist()
         if pos >= 2159:
             return PlaylistResult(indexList[-2])
         try:
@@ -1343,9 +2455,24 @@ class Cache(QtCore.QObject):
         coolDown.start()
         self.playlistActiveDownload[radio] = True
         url = BaseStreamUrl.format(RadioNames[radio]) + PlaylistFileName
+        delta = False
+        lastTime = self.playlistLoadingTime[radio]
+        if (self.indexToFile[radio] and self.playlistCanSkip[radio] and not kwargs.get('full') and 
+            lastTime.msecsTo(QtCore.QDateTime.currentDateTime()) < self.playlistCanSkip[radio] * 500):
+                # the playlist we have must not be older than half the skip
+                # boundary, otherwise we could miss some segments
+                url += '?_HLS_skip=YES'
+                delta = True
         req = QtNetwork.QNetworkRequest(QtCore.QUrl(url))
+        validators = self.playlistValidators[radio]
+        if validators and validators[0] == url and self.indexToFile[radio]:
+            if validators[1]:
+                req.setRawHeader(b'If-None-Match', validators[1])
+            if validators[2]:
+                req.setRawHeader(b'If-Modified-Since', validators[2])
         reply = self.manager.get(req)
         reply.setProperty('radio', radio)
+        reply.setProperty('delta', delta)
         requestTime = kwargs.get('requestTime')
         reply.setProperty('requestTime', requestTime if requestTime else QtCore.QDateTime.currentDateTime())
         reply.setProperty('waitingIndex', kwargs.get('waitingIndex'))
@@ -1355,6 +2482,9 @@ class Cache(QtCore.QObject):
     def playlistDownloadError(self, code):
         reply = self.sender()
         print('error downloading playlist for radio {}'.format(RadioNames[reply.property('radio')]), int(code))
+        if reply.property('delta'):
+            # delta updates might be advertised but not actually supported
+            self.playlistCanSkip[reply.property('radio')] = 0
         requestTime = reply.property('requestTime')
         if requestTime < QtCore.QDateTime.currentDateTime().addSecs(-60):
             print('too much has passed, ignore')
@@ -1370,29 +2500,29 @@ class Cache(QtCore.QObject):
             return
         radio = reply.property('radio')
         self.playlistActiveDownload[radio] = False
-        self.playlistLoadingTime[radio] = reply.property('requestTime')
 
         contentDict = self.indexToFile[radio]
-
-        data = bytes((reply.readAll()))
-        raw = iter(data.decode('utf-8').split('\n'))
-        while True:
-            try:
-                line = next(raw)
-                if line.startswith('#'):
-                    if line.startswith('#EXTINF:'):
-                        lastLength = int(float(line[len('#EXTINF:'):].rstrip(',')) * 1000)
-                elif line:
-                    fileName = line.strip()
-                    index = int(FindIndexRegEx.findall(fileName)[-1])
-                    if not index in contentDict:
-                        contentDict[index] = SegmentInfo(fileName, lastLength)
-            except:
-                break
+        if reply.attribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute) == 304:
+            # not modified since the last request
+            self.playlistLoadingTime[radio] = reply.property('requestTime')
+        else:
+            data = bytes(reply.readAll())
+            self.playlistLoadingTime[radio] = reply.property('requestTime')
+            if not self.parsePlaylist(radio, data, reply.property('delta')):
+                print('delta playlist not usable for radio {}, requesting the full playlist'.format(
+                    RadioNames[radio]))
+                self.downloadPlaylist(radio, full=True, 
+                    requestTime=reply.property('requestTime'), 
+                    waitingIndex=reply.property('waitingIndex'))
+                return
+            self.playlistValidators[radio] = (reply.url().toString(), 
+                bytes(reply.rawHeader(b'ETag')), bytes(reply.rawHeader(b'Last-Modified')))
+            canSkip = FindCanSkipRegEx.search(data[:1024])
+            self.playlistCanSkip[radio] = float(canSkip.group(1)) if canSkip else 0
 
         waitingIndex = reply.property('waitingIndex')
         if waitingIndex is not None:
-            indexes = sorted(self.indexToFile[radio].keys())
+            indexes = contentDict.keys()
             if waitingIndex == -1 or waitingIndex == indexes[-1]:
                 # the next segment might not be ready after 10 seconds,
                 # so we prefer playing the next-to-last
@@ -1404,29 +2534,255 @@ class Cache(QtCore.QObject):
                 except:
                     waitingIndex[0]
             self.fetchIndex(radio, waitingIndex, notify=True)
-            self.fetchIndex(radio, waitingIndex + 1)
+            self.fetchIndex(radio, waitingIndex + 1, priority=ReadAheadPriority)
         self.playlistReceived.emit(radio)
 
-    def downloadIndex(self, radio, index, **kwargs):
-        url = BaseStreamUrl.format(RadioNames[radio]) + self.indexToFile[radio][index].file
-        if url in self.downloadQueue:
+    def playlistTail(self, radio, data):
+        # returns the offset of the first line following the last known
+        # segment, reading the playlist backwards: usually only the last
+        # couple of segments are new
+        contentDict = self.indexToFile[radio]
+        if not contentDict:
+            return
+        lastIndex = contentDict.indexes[-1]
+        end = len(data)
+        while end > 0:
+            start = data.rfind(b'\n', 0, end - 1) + 1
+            line = data[start:end].strip()
+            if line and not line.startswith(b'#'):
+                if int(FindIndexRegEx.findall(line.decode('utf-8'))[-1]) <= lastIndex:
+                    return end
+            end = start
+        # no known segment, the whole playlist is new
+
+    def parsePlaylist(self, radio, data, delta=False):
+        # returns False if a delta playlist does not reach the last known
+        # segment, and the full playlist is required
+        contentDict = self.indexToFile[radio]
+        mediaSequence = FindMediaSequenceRegEx.search(data[:1024])
+        if mediaSequence:
+            mediaSequence = int(mediaSequence.group(1))
+            if self.mediaSequence[radio] is not None and mediaSequence < self.mediaSequence[radio]:
+                print('media sequence reset for radio {}, reloading playlist contents'.format(
+                    RadioNames[radio]))
+                contentDict.clear()
+            self.mediaSequence[radio] = mediaSequence
+        if not self.playlistParsed[radio]:
+            for index, name, duration, start in self.restoredSegments[radio]:
+                contentDict.add(index, name, duration, start)
+            self.restoredSegments[radio] = []
+        tail = self.playlistTail(radio, data) if self.playlistParsed[radio] else None
+        self.playlistParsed[radio] = True
+        if tail is None:
+            if delta:
+                return False
+            tail = 0
+        raw = iter(data[tail:].decode('utf-8').split('\n'))
+        lastLength = 0
+        startTime = -1
+        while True:
+            try:
+                line = next(raw)
+                if line.startswith('#'):
+                    if line.startswith('#EXTINF:'):
+                        lastLength = int(float(line[len('#EXTINF:'):].split(',')[0]) * 1000)
+                    elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+                        dateTime = QtCore.QDateTime.fromString(
+                            line[len('#EXT-X-PROGRAM-DATE-TIME:'):].strip(), QtCore.Qt.ISODateWithMs)
+                        if dateTime.isValid():
+                            startTime = dateTime.toMSecsSinceEpoch()
+                elif line:
+                    fileName = line.strip()
+                    index = int(FindIndexRegEx.findall(fileName)[-1])
+                    contentDict.add(index, fileName, lastLength, startTime)
+                    startTime = -1
+            except:
+                break
+        contentDict.setEndTime(self.playlistLoadingTime[radio].toMSecsSinceEpoch())
+        contentDict.trim()
+        return True
+
+    def setReadAhead(self, radio, index, minimum=0):
+        # moves the read ahead window after the given index; downloads that
+        # are not in the window anymore (after a seek) are cancelled.
+        # The window is never shorter than minimum segments.
+        self.readAheadRadio = radio
+        self.readAheadIndex = index
+        self.readAheadLength = max(self.readAheadSize, minimum)
+        window = self.readAheadWindow()
+        for key in list(self.readAheadJobs):
+            if not key[1] in window or key[0] != radio:
+                print('read ahead of index {} cancelled'.format(key[1]))
+                self.readAheadJobs.discard(key)
+                self.cancelDownload(*key)
+        self.scheduleReadAhead()
+
+    def cancelReadAhead(self):
+        self.setReadAhead(None, -1)
+
+    def readAheadWindow(self):
+        if self.readAheadRadio is None:
+            return range(0)
+        return range(self.readAheadIndex + 1, self.readAheadIndex + 1 + self.readAheadLength)
+
+    def scheduleReadAhead(self):
+        radio = self.readAheadRadio
+        if radio is None:
+            return
+        contents = self.indexToFile[radio]
+        for index in self.readAheadWindow():
+            if len(self.readAheadJobs) >= self.readAheadConcurrency:
+                break
+            key = radio, index
+            if key in self.readAheadJobs:
+                continue
+            # segments not in the playlist yet are scheduled when it arrives
+            if not index in contents or index in self.resident[radio]:
+                continue
+            if self.downloadIndex(radio, index, ReadAheadPriority):
+                self.readAheadJobs.add(key)
+
+    def readAheadDone(self, radio, index):
+        if (radio, index) in self.readAheadJobs:
+            self.readAheadJobs.discard((radio, index))
+            self.scheduleReadAhead()
+
+    def downloadIndex(self, radio, index, priority=BackgroundPriority, **kwargs):
+        # queues the download, returns False if the index is already being
+        # downloaded; a queued download can only be moved to a higher
+        # priority, and only one download at a time can have PlayPriority
+        key = radio, index
+        if key in self.activeDownloads:
             print('still downloading, ignore')
+            return False
+        info = self.indexToFile[radio].get(index)
+        if not info:
+            print('index {} is not in the playlist, not downloaded'.format(index))
+            return False
+        if priority == PlayPriority:
+            for other in list(self.activeDownloads) + list(self.queuedDownloads):
+                if other == key:
+                    continue
+                job = self.queuedDownloads.get(other)
+                reply = self.activeDownloads.get(other)
+                if (job and job[0] == PlayPriority or
+                    reply and reply.property('priority') == PlayPriority):
+                        print('index {} is not going to be played, cancelled'.format(other[1]))
+                        self.cancelDownload(*other)
+        job = self.queuedDownloads.get(key)
+        if job:
+            if job[0] <= priority:
+                return True
+            # heap items cannot be changed, the old one is marked as removed
+            kwargs = dict(job[-1], **kwargs)
+            job[-1] = None
+        self.downloadCount += 1
+        # the url is kept, the index might leave the playlist while queued
+        url = QtCore.QUrl(BaseStreamUrl.format(RadioNames[radio]) + info.file)
+        job = [priority, self.downloadCount, radio, index, url, kwargs]
+        self.queuedDownloads[key] = job
+        heapq.heappush(self.downloadHeap, job)
+        self.processDownloadQueue()
+        return True
+
+    def cancelDownload(self, radio, index):
+        key = radio, index
+        job = self.queuedDownloads.pop(key, None)
+        if job:
+            job[-1] = None
+        reply = self.activeDownloads.get(key)
+        if reply:
+            reply.setProperty('aborted', True)
+            reply.abort()
+
+    def processDownloadQueue(self):
+        while self.downloadHeap:
+            priority, count, radio, index, url, kwargs = self.downloadHeap[0]
+            if kwargs is None:
+                heapq.heappop(self.downloadHeap)
+                continue
+            host = url.host()
+            # the segment that has to be played next never waits
+            if priority != PlayPriority and self.hostDownloads.get(host, 0) >= self.maxHostDownloads:
+                break
+            heapq.heappop(self.downloadHeap)
+            del self.queuedDownloads[(radio, index)]
+            self.startDownload(radio, index, url, priority, **kwargs)
+
+    def startDownload(self, radio, index, url, priority, **kwargs):
+        try:
+            partFile = open(self.partFilePath(radio, url.fileName()), 'wb')
+        except Exception as e:
+            print('cannot write to cache: {}'.format(e))
+            requestTime = kwargs.get('requestTime')
+            self.retryDownload(radio, index, priority, kwargs.get('notify'), 
+                requestTime if requestTime else QtCore.QDateTime.currentDateTime())
             return
-        self.downloadQueue[url] = [0, 0]
-        req = QtNetwork.QNetworkRequest(QtCore.QUrl(url))
+        self.partFiles[(radio, index)] = partFile, hashlib.sha1()
+        self.downloadQueue[url.toString()] = [0, 0]
+        host = url.host()
+        self.hostDownloads[host] = self.hostDownloads.get(host, 0) + 1
+        req = QtNetwork.QNetworkRequest(url)
+        if priority == PlayPriority:
+            req.setPriority(req.HighPriority)
         reply = self.manager.get(req)
+        self.activeDownloads[(radio, index)] = reply
         reply.setProperty('radio', radio)
         reply.setProperty('index', index)
+        reply.setProperty('priority', priority)
         if kwargs.get('notify'):
             reply.setProperty('notify', True)
         requestTime = kwargs.get('requestTime')
         reply.setProperty('requestTime', requestTime if requestTime else QtCore.QDateTime.currentDateTime())
         reply.downloadProgress.connect(self.segmentDownloadProgress)
+        reply.readyRead.connect(self.segmentDataReceived)
         reply.finished.connect(self.segmentDownloadFinished)
         reply.error.connect(self.segmentDownloadError)
 
+    def partFilePath(self, radio, fileName):
+        return self.cacheDirs[radio].absoluteFilePath('.{}.part'.format(fileName))
+
+    def segmentDataReceived(self):
+        reply = self.sender()
+        key = reply.property('radio'), reply.property('index')
+        partFile = self.partFiles.get(key)
+        data = bytes(reply.readAll())
+        if partFile and not reply.error():
+            try:
+                partFile[0].write(data)
+            except OSError as e:
+                # without the part file the download is retried when finished
+                print('cannot write index {} to cache: {}'.format(key[1], e))
+                del self.partFiles[key]
+                try:
+                    partFile[0].close()
+                    os.remove(partFile[0].name)
+                except OSError:
+                    pass
+                return
+            partFile[1].update(data)
+
+    def downloadEnded(self, reply):
+        # called for every segment reply, whatever the result
+        key = reply.property('radio'), reply.property('index')
+        partFile = self.partFiles.pop(key, None)
+        if partFile:
+            partFile[0].close()
+            if reply.error():
+                try:
+                    os.remove(partFile[0].name)
+                except OSError:
+                    pass
+        self.activeDownloads.pop(key, None)
+        self.downloadQueue.pop(reply.url().toString(), None)
+        self.hostDownloads[reply.url().host()] -= 1
+        reply.deleteLater()
+        self.processDownloadQueue()
+
     def segmentDownloadProgress(self, received, total):
         reply = self.sender()
+        if not reply.url().toString() in self.downloadQueue:
+            return
         self.downloadQueue[reply.url().toString()] = [received, total]
         r = t = 0
         for sr, st in self.downloadQueue.values():
@@ -1436,55 +2792,103 @@ class Cache(QtCore.QObject):
 
     def segmentDownloadError(self, code):
         reply = self.sender()
-        self.downloadQueue.pop(reply.url().toString())
         radio = reply.property('radio')
         index = reply.property('index')
+        if reply.property('aborted'):
+            # cancelled on purpose, do not retry
+            return
         print('error downloading file {} for radio {}: {}'.format(
             index, RadioNames[radio], NetworkErrors[code]))
-        requestTime = reply.property('requestTime')
+        self.retryDownload(radio, index, reply.property('priority'), 
+            reply.property('notify'), reply.property('requestTime'))
+
+    def retryDownload(self, radio, index, priority, notify, requestTime):
+        if (radio, index) in self.readAheadJobs:
+            # the scheduler will try again, if still needed
+            self.readAheadJobs.discard((radio, index))
+            QtCore.QTimer.singleShot(1000, self.scheduleReadAhead)
+            return
         if requestTime < QtCore.QDateTime.currentDateTime().addSecs(-60):
             print('too much has passed, ignore')
             return
-        QtCore.QTimer.singleShot(1000, lambda: 
-                self.downloadIndex(radio, index, 
-                    notify=reply.property('notify', requestTime=requestTime) ))
+        QtCore.QTimer.singleShot(1000, lambda:
+                self.downloadIndex(radio, index, priority,
+                    notify=notify, requestTime=requestTime))
 
     def segmentDownloadFinished(self):
         reply = self.sender()
-        if reply.error():
-            return
         radio = reply.property('radio')
-        self.downloadQueue.pop(reply.url().toString())
-        fileName = reply.url().fileName()
-        filePath = self.cacheDirs[radio].absoluteFilePath(fileName)
-        f = QtCore.QFile(filePath)
-        f.open(f.WriteOnly)
-        f.write(bytes((reply.readAll())))
-        f.close()
         index = reply.property('index')
+        partFile = self.partFiles.get((radio, index))
+        if partFile and not reply.error():
+            partFile, checksum = partFile
+            try:
+                data = bytes(reply.readAll())
+                partFile.write(data)
+                partFile.flush()
+                checksum.update(data)
+                if self.fsyncDownloads:
+                    os.fsync(partFile.fileno())
+                partFile.close()
+                # the file appears in the cache only when it is complete
+                checksum = checksum.hexdigest()
+                fileName = shardPath(checksum)
+                checkDir(checksum[:2], self.cacheDirs[radio])
+                os.replace(partFile.name, self.cacheDirs[radio].absoluteFilePath(fileName))
+                info = self.indexToFile[radio].get(index)
+                self.addResident(radio, index, CacheEntry(fileName, os.path.getsize(
+                    self.cacheDirs[radio].absoluteFilePath(fileName)), 
+                    QtCore.QDateTime.currentMSecsSinceEpoch()), reply.url().fileName(), 
+                    duration=info.length if info else -1, 
+                    start=self.indexToFile[radio].startTime(index) or -1 if info else -1, 
+                    checksum=checksum)
+                sizeLimit = self.settings.value('cacheSizeLimit', 0, type=int) * 1048576
+                if sizeLimit and self.cacheTotalSize > sizeLimit:
+                    self.clearCacheTimer.start(0)
+            except Exception as e:
+                print('cannot write index {} to cache: {}'.format(index, e))
+                try:
+                    os.remove(partFile.name)
+                except OSError:
+                    pass
+                partFile = None
+        self.downloadEnded(reply)
+        if reply.error():
+            return
+        if not partFile:
+            self.retryDownload(radio, index, reply.property('priority'), 
+                reply.property('notify'), reply.property('requestTime'))
+            return
         self.segmentDownloaded.emit(radio, index)
         if reply.property('notify'):
             self.segmentNotify.emit(radio, index)
         print('index {} downloaded!'.format(index))
+        self.readAheadDone(radio, index)
+
+    def residentMask(self, radio, indexes):
+        # for each index in the array, whether its file is in the cache
+        resident = self.resident[radio]
+        return np.fromiter((index in resident for index in indexes.tolist()), 
+            dtype=bool, count=len(indexes))
 
     def indexFileExists(self, radio, index):
         contents = self.indexToFile[radio]
         if not contents:
             return PlaylistResult.Empty()
-        info = contents.get(index)
-        if not info:
+        if not index in contents:
             return PlaylistResult.DoesNotExist()
-        return PlaylistResult(self.cacheDirs[radio].exists(info.file))
+        return PlaylistResult(index in self.resident[radio])
 
-    def fetchIndex(self, radio, index, notify=False):
-        info = self.indexToFile[radio].get(index)
-        if not info:
+    def fetchIndex(self, radio, index, notify=False, priority=BackgroundPriority):
+        if not index in self.indexToFile[radio]:
             print('index {} does not exist, downloading playlist again'.format(index))
 #            self.downloadPlaylist(radio, waitingIndex=index)
             self.downloadPlaylist(radio)
             return
-        elif not self.cacheDirs[radio].exists(info.file):
-            self.downloadIndex(radio, index, notify=notify)
+        elif not index in self.resident[radio]:
+            if notify:
+                priority = PlayPriority
+            self.downloadIndex(radio, index, priority, notify=notify)
             print('downloading index {}'.format(index))
             return
         elif notify:
@@ -1495,9 +2899,10 @@ class Cache(QtCore.QObject):
     def getPathFromIndex(self, radio, index, getNext=False, notify=False):
         if getNext:
             QtCore.QTimer.singleShot(0, lambda: self.fetchIndex(radio, index))
-        info = self.indexToFile[radio].get(index)
-        if info and self.cacheDirs[radio].exists(info.file):
-            return self.cacheDirs[radio].absoluteFilePath(info.file)
+        entry = self.resident[radio].get(index)
+        if entry:
+            self.touchResident(radio, index)
+            return self.cacheDirs[radio].absoluteFilePath(entry.file)
         print('file {} does not exist!'.format(index))
         self.fetchIndex(radio, index, notify=notify)
 #        if info:
@@ -1505,8 +2910,475 @@ class Cache(QtCore.QObject):
 #            return True
 
 
+def copyFileContents(source, dest):
+    # appends the source file to dest, in the kernel if possible, otherwise
+    # in fixed size chunks: memory usage does not depend on the file size
+    dest.flush()
+    offset = 0
+    if hasattr(os, 'sendfile'):
+        size = os.fstat(source.fileno()).st_size
+        try:
+            while offset < size:
+                sent = os.sendfile(dest.fileno(), source.fileno(), offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+            if offset >= size:
+                return
+        except OSError:
+            pass
+    source.seek(offset)
+    while True:
+        chunk = source.read(ExportChunkSize)
+        if not chunk:
+            break
+        dest.write(chunk)
+
+
+class ExportWorker(QtCore.QRunnable):
+    def __init__(self, exporter, paths, filePath):
+        super().__init__()
+        self.exporter = exporter
+        self.paths = paths
+        self.filePath = filePath
+
+    def run(self):
+        # the recording is written to a hidden file, and renamed at the end
+        dirName, fileName = os.path.split(self.filePath)
+        partPath = os.path.join(dirName, '.{}.part'.format(fileName))
+        error = ''
+        try:
+            with open(partPath, 'wb') as recFile:
+                for count, path in enumerate(self.paths, 1):
+                    if self.exporter.cancelled:
+                        raise Exception('cancelled')
+                    with open(path, 'rb') as source:
+                        copyFileContents(source, recFile)
+                    self.exporter.progress.emit(count, len(self.paths))
+            os.replace(partPath, self.filePath)
+        except Exception as e:
+            error = str(e)
+            try:
+                os.remove(partPath)
+            except OSError:
+                pass
+        self.exporter.workerDone.emit(error)
+
+
+class RecordingExporter(QtCore.QObject):
+    # Creates a recording file from a range of segments: missing segments
+    # are downloaded first, then the files are copied in a worker thread.
+    # The range is pinned in the cache until the export ends.
+    fetching = QtCore.pyqtSignal(int)
+    progress = QtCore.pyqtSignal(int, int)
+    workerDone = QtCore.pyqtSignal(str)
+    exported = QtCore.pyqtSignal(str)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, parent, cache, radio, start, end, filePath, pin=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.radio = radio
+        self.start = start
+        self.end = end
+        self.filePath = filePath
+        self.pin = pin if pin is not None else cache.pin(radio, start, end)
+        self.missing = set()
+        self.cancelled = False
+        self.fetchTimer = QtCore.QTimer(interval=5000, timeout=self.fetchMissing)
+        self.fetchElapsed = QtCore.QElapsedTimer()
+        self.workerDone.connect(self.workerFinished)
+
+    def exportRecording(self):
+        resident = self.cache.resident[self.radio]
+        self.missing = set(index for index in range(self.start, self.end + 1) if not index in resident)
+        if not self.missing:
+            self.startWorker()
+            return
+        self.cache.segmentDownloaded.connect(self.segmentDownloaded)
+        self.fetchElapsed.start()
+        self.fetchMissing()
+        self.fetchTimer.start()
+
+    def fetchMissing(self):
+        if self.fetchElapsed.hasExpired(60000):
+            self.finish('{} segments could not be downloaded'.format(len(self.missing)))
+            return
+        for index in sorted(self.missing):
+            if not index in self.cache.indexToFile[self.radio]:
+                self.finish('segment {} is not available anymore'.format(index))
+                return
+            self.cache.fetchIndex(self.radio, index, priority=RecordPriority)
+        self.fetching.emit(len(self.missing))
+
+    def segmentDownloaded(self, radio, index):
+        if radio != self.radio or not index in self.missing:
+            return
+        self.missing.discard(index)
+        self.fetchElapsed.restart()
+        self.fetching.emit(len(self.missing))
+        if not self.missing:
+            self.fetchTimer.stop()
+            self.cache.segmentDownloaded.disconnect(self.segmentDownloaded)
+            self.startWorker()
+
+    def startWorker(self):
+        resident = self.cache.resident[self.radio]
+        if not all(index in resident for index in range(self.start, self.end + 1)):
+            # evicted in the meantime, even if pinned (e.g. removed from disk)
+            self.exportRecording()
+            return
+        paths = [self.cache.getPathFromIndex(self.radio, index) for index in range(self.start, self.end + 1)]
+        QtCore.QThreadPool.globalInstance().start(ExportWorker(self, paths, self.filePath))
+
+    def workerFinished(self, error):
+        if error and not self.cancelled:
+            missing = [self.cache.dropMissingFile(self.radio, index) 
+                for index in range(self.start, self.end + 1)]
+            if any(missing):
+                # files deleted from the cache, download them again
+                self.exportRecording()
+                return
+        self.finish(error)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.fetchTimer.isActive():
+            self.finish('cancelled')
+
+    def finish(self, error=''):
+        if self.pin is None:
+            return
+        self.fetchTimer.stop()
+        try:
+            self.cache.segmentDownloaded.disconnect(self.segmentDownloaded)
+        except TypeError:
+            pass
+        self.cache.unpin(self.pin)
+        self.pin = None
+        if error:
+            print('cannot export recording {}: {}'.format(self.filePath, error))
+            self.failed.emit(error)
+        else:
+            self.exported.emit(self.filePath)
+        self.deleteLater()
+
+
+class LiveRecorder(QtCore.QObject):
+    # Records a radio while its segments arrive, whether it is playing or
+    # not: the playlist is reloaded periodically, new segments are
+    # downloaded and appended to the file, in order, as soon as they are
+    # in the cache. Recordings do not depend on the cache size or time.
+    # With an end time (in milliseconds since epoch), finished is emitted
+    # as soon as the segment playing at that time is written.
+    segmentWritten = QtCore.pyqtSignal(int)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, parent, cache, radio, filePath, start=None, startTime=None, endTime=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.radio = radio
+        self.filePath = filePath
+        # without a start index, recording begins with the segment playing
+        # at startTime, or with the next segment
+        if start is not None and start < 0:
+            start = None
+        self.firstIndex = self.nextIndex = start
+        self.startTime = startTime
+        self.endTime = endTime
+        self.complete = False
+        self.lastIndex = None
+        self.count = 0
+        # indexes whose download has been requested by the recorder
+        self.fetching = set()
+        self.recFile = open(filePath, 'ab')
+        self.playlistTimer = QtCore.QTimer(interval=5000, 
+            timeout=lambda: self.cache.downloadPlaylist(self.radio))
+        self.playlistTimer.start()
+        self.cache.segmentDownloaded.connect(self.segmentDownloaded)
+        self.cache.playlistReceived.connect(self.playlistReceived)
+        self.cache.downloadPlaylist(radio)
+
+    def playlistReceived(self, radio):
+        contents = self.cache.indexToFile[radio]
+        if radio != self.radio or not contents or not self.recFile:
+            return
+        indexes = contents.indexes
+        if self.nextIndex is None:
+            pos = len(indexes) - 1
+            if self.startTime is not None:
+                # if it is older than the playlist, record what is left
+                pos = max(0, int(np.searchsorted(contents.starts, self.startTime, side='right')) - 1)
+            self.firstIndex = self.nextIndex = int(indexes[pos])
+        pos = int(np.searchsorted(indexes, self.nextIndex))
+        pending = indexes[pos:]
+        if self.endTime is not None:
+            # segments starting after the end time are not going to be recorded
+            pending = pending[contents.starts[pos:] < self.endTime]
+        resident = self.cache.resident[radio]
+        for index in pending.tolist():
+            if not index in resident:
+                self.fetching.add(index)
+                self.cache.fetchIndex(radio, index, priority=RecordPriority)
+        self.writeAvailable()
+
+    def segmentDownloaded(self, radio, index):
+        if radio == self.radio and index == self.nextIndex:
+            self.writeAvailable()
+
+    def writeAvailable(self):
+        resident = self.cache.resident[self.radio]
+        contents = self.cache.indexToFile[self.radio]
+        while self.recFile and self.nextIndex is not None and not self.complete:
+            index = self.nextIndex
+            if index in resident:
+                if not self.append(index):
+                    # the file was missing, wait for it to be downloaded again
+                    break
+            elif not index in contents and contents and index < contents.indexes[-1]:
+                print('index {} is not available anymore, not recorded'.format(index))
+            else:
+                break
+            self.nextIndex += 1
+
+    def append(self, index):
+        try:
+            with open(self.cache.getPathFromIndex(self.radio, index), 'rb') as source:
+                copyFileContents(source, self.recFile)
+            self.recFile.flush()
+        except Exception as e:
+            print('cannot record index {}: {}'.format(index, e))
+            if self.cache.dropMissingFile(self.radio, index):
+                self.fetching.add(index)
+                self.cache.fetchIndex(self.radio, index, priority=RecordPriority)
+                return False
+            return True
+        self.fetching.discard(index)
+        if self.lastIndex is None:
+            self.firstIndex = index
+        self.lastIndex = index
+        self.count += 1
+        self.segmentWritten.emit(self.count)
+        if self.endTime is not None:
+            endTime = self.cache.getTimeFromIndex(self.radio, index, end=True)
+            if endTime and endTime.toMSecsSinceEpoch() >= self.endTime:
+                self.complete = True
+                self.cancelDownloads()
+                self.finished.emit()
+        return True
+
+    def cancelDownloads(self):
+        # downloads still waiting in the queue only for the recording are
+        # not needed anymore; those requested with a higher priority (for
+        # playback) are left alone
+        for index in self.fetching:
+            job = self.cache.queuedDownloads.get((self.radio, index))
+            if job and job[0] == RecordPriority:
+                self.cache.cancelDownload(self.radio, index)
+        self.fetching.clear()
+
+    def stop(self):
+        # returns the first and last recorded index
+        self.playlistTimer.stop()
+        self.cache.segmentDownloaded.disconnect(self.segmentDownloaded)
+        self.cache.playlistReceived.disconnect(self.playlistReceived)
+        self.cancelDownloads()
+        self.recFile.close()
+        self.recFile = None
+        self.deleteLater()
+        return self.firstIndex, self.lastIndex
+
+
+def escapeMetadata(text):
+    # special characters of the ffmpeg metadata file format
+    return re.sub(r'([=;#\\\n])', r'\\\1', text)
+
+
+class RecordingRemuxer(QtCore.QObject):
+    # Copies the ADTS stream of a recording into an M4A file with ffmpeg,
+    # without encoding it again: the container has a sample table, so the
+    # duration is exact and players can seek without reading the whole
+    # file. Chapters are given as (start, end, title), in milliseconds.
+    remuxed = QtCore.pyqtSignal(str)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, parent, sourcePath, filePath, title='', chapters=None):
+        super().__init__(parent)
+        self.sourcePath = sourcePath
+        self.filePath = filePath
+        # ffmpeg writes to a hidden file, renamed only if successful
+        dirName, fileName = os.path.split(filePath)
+        self.partPath = os.path.join(dirName, '.{}.part'.format(fileName))
+        self.title = title
+        self.chapters = chapters or []
+        self.metadataFile = None
+        self.process = QtCore.QProcess(self)
+        self.process.finished.connect(self.processFinished)
+        self.process.errorOccurred.connect(self.processError)
+
+    def remux(self):
+        self.metadataFile = QtCore.QTemporaryFile(
+            QtCore.QDir.temp().absoluteFilePath('rsiplay-XXXXXX.txt'), self)
+        if not self.metadataFile.open():
+            self.finish('cannot create metadata file')
+            return
+        metadata = ';FFMETADATA1\ntitle={}\n'.format(escapeMetadata(self.title))
+        for start, end, title in self.chapters:
+            metadata += '[CHAPTER]\nTIMEBASE=1/1000\nSTART={}\nEND={}\ntitle={}\n'.format(
+                start, end, escapeMetadata(title))
+        self.metadataFile.write(metadata.encode('utf-8'))
+        self.metadataFile.flush()
+        self.process.start(pydub.AudioSegment.converter, [
+            '-y', '-loglevel', 'error', 
+            '-i', self.sourcePath, '-i', self.metadataFile.fileName(), 
+            '-map', '0:a', '-map_metadata', '1', '-map_chapters', '1', 
+            '-c', 'copy', '-bsf:a', 'aac_adtstoasc', 
+            # the index goes at the beginning, files open immediately
+            '-movflags', '+faststart', 
+            '-f', 'ipod', self.partPath])
+
+    def processError(self, error):
+        if error == QtCore.QProcess.FailedToStart:
+            self.finish('cannot run {}'.format(pydub.AudioSegment.converter))
+
+    def processFinished(self, exitCode, exitStatus):
+        if exitStatus != QtCore.QProcess.NormalExit or exitCode:
+            self.finish(bytes(self.process.readAllStandardError()).decode('utf-8', 'replace').strip() or 
+                'ffmpeg exited with code {}'.format(exitCode))
+            return
+        try:
+            os.replace(self.partPath, self.filePath)
+        except Exception as e:
+            self.finish(str(e))
+            return
+        self.finish()
+
+    def finish(self, error=''):
+        if self.metadataFile:
+            self.metadataFile.close()
+        if error:
+            print('cannot export recording {}: {}'.format(self.filePath, error))
+            if os.path.exists(self.partPath):
+                os.remove(self.partPath)
+            self.failed.emit(error)
+        else:
+            self.remuxed.emit(self.filePath)
+        self.deleteLater()
+
+
+class RecordingScheduler(QtCore.QObject):
+    # Recordings planned in advance, for a program or a time range of any
+    # radio: they are kept in the settings, and a LiveRecorder runs for
+    # each of them when the time comes, even if the window is hidden.
+    recordingStarted = QtCore.pyqtSignal(int, str)
+    # part file path, radio, first and last index, title
+    recorded = QtCore.pyqtSignal(str, int, int, int, str)
+
+    def __init__(self, parent, cache, recordDir):
+        super().__init__(parent)
+        self.cache = cache
+        self.recordDir = QtCore.QDir(recordDir)
+        self.settings = QtCore.QSettings()
+        try:
+            self.scheduled = sorted(ScheduledRecording(*recording) for recording in 
+                json.loads(self.settings.value('scheduledRecordings', '[]', type=str)))
+        except Exception as e:
+            print('cannot read scheduled recordings: {}'.format(e))
+            self.scheduled = []
+        self.active = {}
+        self.timer = QtCore.QTimer(singleShot=True, timeout=self.checkSchedule)
+        self.timer.start(0)
+
+    def save(self):
+        self.settings.setValue('scheduledRecordings', json.dumps([list(r) for r in self.scheduled]))
+
+    def find(self, radio, start):
+        for recording in self.scheduled:
+            if recording.radio == radio and recording.start == start:
+                return recording
+
+    def add(self, radio, start, end, title):
+        start = start.toMSecsSinceEpoch()
+        end = end.toMSecsSinceEpoch()
+        if end <= start or self.find(radio, start):
+            return
+        self.scheduled.append(ScheduledRecording(radio, start, end, title))
+        self.scheduled.sort()
+        self.save()
+        self.checkSchedule()
+
+    def remove(self, recording):
+        if recording in self.active:
+            # keep what has been recorded until now
+            self.finish(recording)
+            return
+        if recording in self.scheduled:
+            self.scheduled.remove(recording)
+            self.save()
+        self.checkSchedule()
+
+    def checkSchedule(self):
+        now = QtCore.QDateTime.currentMSecsSinceEpoch()
+        nextCheck = None
+        for recording in list(self.scheduled):
+            if recording in self.active:
+                # segments should have arrived long before this
+                if now > recording.end + 120000:
+                    print('scheduled recording "{}" did not end, stopped'.format(recording.title))
+                    self.finish(recording)
+                    continue
+                check = recording.end + 120000
+            elif recording.end < now - 21600000:
+                # not even in the playlist anymore
+                print('scheduled recording "{}" expired'.format(recording.title))
+                self.scheduled.remove(recording)
+                self.save()
+                continue
+            elif recording.start <= now:
+                self.startRecording(recording)
+                check = recording.end + 120000
+            else:
+                check = recording.start
+            nextCheck = check if nextCheck is None else min(nextCheck, check)
+        if nextCheck is not None:
+            # check at least every hour, the clock might have changed
+            self.timer.start(min(max(0, nextCheck - now), 3600000))
+        else:
+            self.timer.stop()
+
+    def startRecording(self, recording):
+        filePath = self.recordDir.absoluteFilePath('.{}-{}.part'.format(
+            RadioNames[recording.radio], recording.start))
+        if os.path.exists(filePath):
+            # interrupted before, start again
+            os.remove(filePath)
+        recorder = LiveRecorder(self, self.cache, recording.radio, filePath, 
+            startTime=recording.start, endTime=recording.end)
+        recorder.finished.connect(lambda recording=recording: self.finish(recording))
+        self.active[recording] = recorder
+        print('scheduled recording "{}" started'.format(recording.title))
+        self.recordingStarted.emit(recording.radio, recording.title)
+
+    def finish(self, recording):
+        recorder = self.active.pop(recording, None)
+        if recording in self.scheduled:
+            self.scheduled.remove(recording)
+            self.save()
+        QtCore.QTimer.singleShot(0, self.checkSchedule)
+        if not recorder:
+            return
+        start, end = recorder.stop()
+        if end is None:
+            print('scheduled recording "{}" is empty'.format(recording.title))
+            os.remove(recorder.filePath)
+            return
+        self.recorded.emit(recorder.filePath, recording.radio, start, end, recording.title)
+
+
 class DownloadWidget(QtWidgets.QFrame):
-    def __init__(self, parent=None):
+    cancelRequested = QtCore.pyqtSignal()
+
+    def __init__(self, parent=None, cancellable=False):
         super().__init__(parent)
         self.setFrameShape(self.StyledPanel | self.Sunken)
         layout = QtWidgets.QHBoxLayout(self)
@@ -1521,6 +3393,14 @@ class DownloadWidget(QtWidgets.QFrame):
         self.progressBar = QtWidgets.QProgressBar()
         layout.addWidget(self.progressBar)
         self.progressBar.setMaximumWidth(100)
+
+        self.cancelBtn = QtWidgets.QToolButton()
+        self.cancelBtn.setIcon(QtGui.QIcon('delete.svg'))
+        self.cancelBtn.setToolTip('Cancel')
+        self.cancelBtn.setAutoRaise(True)
+        self.cancelBtn.setVisible(cancellable)
+        layout.addWidget(self.cancelBtn)
+        self.cancelBtn.clicked.connect(self.cancelRequested)
         self.hideTimer = QtCore.QTimer(singleShot=True, interval=2000, timeout=self.hide)
         self.hide()
 
@@ -1535,6 +3415,21 @@ class DownloadWidget(QtWidgets.QFrame):
         self.progressBar.setValue(int(received / total * 100))
         self.hideTimer.start()
 
+    def setFetchStatus(self, missing):
+        self.show()
+        self.label.setText('Recording: waiting for {c} segment{p}'.format(
+            c = missing, 
+            p = 's' if missing > 1 else ''
+            ))
+        self.progressBar.setValue(0)
+        self.hideTimer.start()
+
+    def setExportStatus(self, written, total):
+        self.show()
+        self.label.setText('Recording: {w}/{t} segments'.format(w = written, t = total))
+        self.progressBar.setValue(int(written / total * 100))
+        self.hideTimer.start()
+
 
 class LimitedTimeEdit(QtWidgets.QTimeEdit):
     customTimeChanged = QtCore.pyqtSignal(QtCore.QTime)
@@ -1766,7 +3661,7 @@ class RsiPlayer(QtWidgets.QMainWindow):
             self.songLogTimers.append(
                 QtCore.QTimer(singleShot=True, interval=60000, timeout=self.requestSongLog))
         self.nextToPlay = None
-        self.recordStart = None
+        self.liveRecorder = None
         self._seeking = False
 
         self.manager = QtNetwork.QNetworkAccessManager()
@@ -1789,6 +3684,8 @@ class RsiPlayer(QtWidgets.QMainWindow):
         self.panel.addTab(self.nowPlaying, QtGui.QIcon('info.svg'), 'No&w playing')
         self.nowPlaying.anchorClicked.connect(self.goToClickedTime)
         self.nowPlaying.refreshRequested.connect(self.requestSongLog)
+        self.nowPlaying.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.nowPlaying.customContextMenuRequested.connect(self.nowPlayingMenu)
 
         self.recordTree = QtWidgets.QTreeView()
         self.recordModel = RecordModel(self)
@@ -1807,6 +3704,8 @@ class RsiPlayer(QtWidgets.QMainWindow):
 
         self.downloadStatusWidget = DownloadWidget()
         self.statusBar().addPermanentWidget(self.downloadStatusWidget)
+        self.exportStatusWidget = DownloadWidget(cancellable=True)
+        self.statusBar().addPermanentWidget(self.exportStatusWidget)
 
 
 #        self.resize(self.width(), self.sizeHint().height())
@@ -1816,9 +3715,16 @@ class RsiPlayer(QtWidgets.QMainWindow):
 
         self.cache = Cache(self)
         self.cache.segmentNotify.connect(self.segmentReadyToPlay)
+        self.cache.segmentDownloaded.connect(lambda radio, index: self.seekSlider.update())
+        self.cache.cacheCleared.connect(lambda toRemove, removed: self.seekSlider.update())
         self.cache.downloadStatusUpdate.connect(self.downloadStatusWidget.setStatus)
         self.cache.playlistReceived.connect(self.reloadLog)
 
+        self.scheduler = RecordingScheduler(self, self.cache, self.recordDir)
+        self.scheduler.recordingStarted.connect(lambda radio, title: self.trayIcon.showMessage(
+            'Recording started', '{}: {}'.format(RadioTitles[radio], title), self.windowIcons[radio]))
+        self.scheduler.recorded.connect(self.scheduledRecordingDone)
+
         self.player = AudioPlayer(self)
 #        self.player.request.connect(self.requestIndex)
         self.player.currentStateChanged.connect(self.playerStateChanged)
@@ -1865,6 +3771,12 @@ class RsiPlayer(QtWidgets.QMainWindow):
 
         self.trayMenu.addSeparator()
 
+        self.scheduleMenu = self.trayMenu.addMenu(QtGui.QIcon('record.svg'), 'Schedule recording')
+        self.scheduleMenu.aboutToShow.connect(
+            lambda: self.fillScheduleMenu(self.scheduleMenu, range(len(RadioNames))))
+
+        self.trayMenu.addSeparator()
+
         if self.settings.value('playOnStart', -2, type=int) in (-2, 1):
             QtCore.QTimer.singleShot(0, lambda: self.playToggleBtn.setChecked(True))
 
@@ -1912,7 +3824,7 @@ class RsiPlayer(QtWidgets.QMainWindow):
         menu = QtWidgets.QMenu(self)
         saveAsAction = menu.addAction(QtGui.QIcon('save.svg'), 'Save as...')
         exportAction = menu.addAction(QtGui.QIcon('export.svg'), 'Export file...')
-        exportAction.setEnabled(False)
+        exportAction.setEnabled(index.parent() != self.recordModel.unknownItems)
         menu.addSeparator()
         deleteAction = menu.addAction(QtGui.QIcon('delete.svg'), 'Delete file')
         res = menu.exec_(QtGui.QCursor.pos())
@@ -1924,7 +3836,7 @@ class RsiPlayer(QtWidgets.QMainWindow):
                 except Exception as e:
                     print('error copying!', e)
         elif res == exportAction:
-            print('esporta')
+            self.exportRecording(index.data(RecordFileRole))
         elif res == deleteAction and QtWidgets.QMessageBox.critical(self, 'Delete recording?', 
             'Are you sure you want to delete the selected recording?\nThe operation cannot be undone!!!', 
             QtWidgets.QMessageBox.Ok|QtWidgets.QMessageBox.Cancel) == QtWidgets.QMessageBox.Ok:
@@ -1934,6 +3846,40 @@ class RsiPlayer(QtWidgets.QMainWindow):
                 except Exception as e:
                     print('error removing!', e)
 
+    def exportRecording(self, fileInfo):
+        radio, start, end, name = parseRecordFileName(fileInfo.fileName())
+        filePath, filter = QtWidgets.QFileDialog.getSaveFileName(self, 'Export recording', 
+            fileInfo.completeBaseName() + '.m4a', filter='M4A file (*.m4a)')
+        if not filePath:
+            return
+        # songs of the song log played during the recording become chapters
+        songs = []
+        for song in self.songLogs[radio]:
+            time = QtCore.QDateTime(start.date(), QtCore.QTime.fromString(song.get('timeOfPlayback')))
+            if not time.isValid():
+                continue
+            if time < start.addSecs(-43200):
+                time = time.addDays(1)
+            if start <= time < end:
+                artist = song.get('artist')
+                if isinstance(artist, dict):
+                    artist = artist.get('name')
+                title = song.get('title', '(no title)')
+                songs.append((start.msecsTo(time), '{} - {}'.format(title, artist) if artist else title))
+        songs.sort()
+        duration = start.msecsTo(end)
+        chapters = []
+        for (songStart, title), nextStart in zip(songs, [s[0] for s in songs[1:]] + [duration]):
+            chapters.append((songStart, nextStart, title))
+
+        remuxer = RecordingRemuxer(self, fileInfo.absoluteFilePath(), filePath, 
+            '{} - {}'.format(RadioTitles[radio], name), chapters)
+        remuxer.remuxed.connect(lambda filePath: self.statusBar().showMessage(
+            'Recording exported to {}'.format(filePath), 5000))
+        remuxer.failed.connect(lambda error: self.statusBar().showMessage(
+            'Export failed: {}'.format(error), 5000))
+        remuxer.remux()
+
     def togglePanel(self, show):
         if show:
             self.setMinimumHeight(0)
@@ -1953,7 +3899,8 @@ class RsiPlayer(QtWidgets.QMainWindow):
         self.recEndBtn.setVisible(show)
         self.checkRecordButtons()
         timedRecording = show or self.toggleRecPanelBtn.isChecked() and self.canRecord()
-        self.recordBtn.setEnabled(timedRecording)
+        # a live recording must always be possible to stop
+        self.recordBtn.setEnabled(timedRecording or self.liveRecorder is not None)
         if show and self.seekSlider.recStart() < 0:
             self.seekSlider.beginRecStart()
         else:
@@ -2026,6 +3973,7 @@ class RsiPlayer(QtWidgets.QMainWindow):
         self.recordTree.header().setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
         self.recordTree.header().setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeToContents)
         self.recordTree.header().setSectionResizeMode(3, QtWidgets.QHeaderView.ResizeToContents)
+        self.recordTree.header().setSectionResizeMode(4, QtWidgets.QHeaderView.ResizeToContents)
         self.recordTree.expandAll()
 
     def updateTimeStamp(self):
@@ -2038,14 +3986,12 @@ class RsiPlayer(QtWidgets.QMainWindow):
             print('\n\nWHATTAFUNK?!\nNo playlist loading time reference?!\n\n')
 #            continua da qui
         else:
-            currentIndex = self.player.currentIndex
-            contents = self.cache.indexToFile[self.lastRadio]
-            for index in sorted(contents.keys(), reverse=True):
-                info = contents[index]
-                if not info or currentIndex == index:
-                    break
-                lastTime = lastTime.addMSecs(-info.length)
-        lastTime = lastTime.addMSecs(self.player.bytePos / 44.1)
+            segmentTime = self.cache.getTimeFromIndex(self.lastRadio, self.player.currentIndex)
+            if segmentTime is not None:
+                lastTime = segmentTime
+            else:
+                lastTime = lastTime.addMSecs(-self.cache.indexToFile[self.lastRadio].totalLength())
+        lastTime = lastTime.addMSecs(self.player.framesToMSecs(self.player.bytePos))
 #        self.timeEdit.blockSignals(True)
         self.timeEdit.setTime(lastTime.time())
 #        self.timeEdit.blockSignals(False)
@@ -2115,29 +4061,25 @@ class RsiPlayer(QtWidgets.QMainWindow):
 #                self.recEndBtn.setEnabled(True)
 
     def playerIndexChanged(self, currentIndex):
-        contents = self.cache.indexToFile[self.lastRadio]
-        cacheIndexes = sorted(contents.keys(), reverse=True)
-        lastTime = self.cache.playlistLoadingTime[self.lastRadio]
-        pos = 2160
-        previousPos = self.seekSlider.value()
-        for index in cacheIndexes:
-            pos -= 1
-            lastTime = lastTime.addMSecs(-contents[index].length)
-            if index == currentIndex:
-                # this is *VERY* arbitrary approach... since the slider range is
-                # 0-2160, we shouldn't rely to pixel-perfect positioning.
-                print('slider (probably) moved from player', previousPos, pos)
-                if abs(pos - previousPos) > 2:
-                    self.seekSlider.blockSignals(True)
-                    self.seekSlider.setValue(pos)
-                    self.seekSlider.blockSignals(False)
-                    self.timeEdit.blockSignals(True)
-                    self.timeEdit.setTime(lastTime.time())
-                    print('time moved from slider LAST {} EDIT {}'.format(lastTime, self.timeEdit.dateTime()))
-                    self.timeEdit.blockSignals(False)
-                break
-        else:
+        segmentIndex = self.cache.indexToFile[self.lastRadio]
+        indexPos = segmentIndex.position(currentIndex)
+        if indexPos < 0:
             print('Player index changed, but index not found?!')
+            return
+        pos = 2160 - len(segmentIndex) + indexPos
+        previousPos = self.seekSlider.value()
+        # this is *VERY* arbitrary approach... since the slider range is
+        # 0-2160, we shouldn't rely to pixel-perfect positioning.
+        print('slider (probably) moved from player', previousPos, pos)
+        if abs(pos - previousPos) > 2:
+            lastTime = self.cache.getTimeFromIndex(self.lastRadio, currentIndex)
+            self.seekSlider.blockSignals(True)
+            self.seekSlider.setValue(pos)
+            self.seekSlider.blockSignals(False)
+            self.timeEdit.blockSignals(True)
+            self.timeEdit.setTime(lastTime.time())
+            print('time moved from slider LAST {} EDIT {}'.format(lastTime, self.timeEdit.dateTime()))
+            self.timeEdit.blockSignals(False)
 
     def seekSliderMoved(self, value):
         self.liveBtn.setDown(value == self.seekSlider.maximum() and self.playToggleBtn.isChecked())
@@ -2164,7 +4106,7 @@ class RsiPlayer(QtWidgets.QMainWindow):
 #                    self.player.start(res.value(), self.lastRadio)
 #                else:
 #                    self.cache.downloadPlaylist(self.lastRadio, waitingIndex=index)
-                contents = list(sorted(self.cache.indexToFile[self.lastRadio].keys()))
+                contents = self.cache.indexToFile[self.lastRadio].indexes
                 print('seeking', index, len(contents), contents[:2], contents[-3:])
                 if self.cache.getPathFromIndex(self.lastRadio, index, notify=True):
                     print('seeking ok, starting', index)
@@ -2224,34 +4166,36 @@ class RsiPlayer(QtWidgets.QMainWindow):
 #            self.loadPlaylist(requestSongLog=True)
 #            self.playlistRequestTimer.start()
         else:
-            if self.recordBtn.isChecked() and QtWidgets.QMessageBox.question(self, 
-                'Stop recording?', 'Recording in process, do you want to stop?', 
-                QtWidgets.QMessageBox.Ok|QtWidgets.QMessageBox.Cancel) != QtWidgets.QMessageBox.Ok:
-                    self.playToggleBtn.blockSignals(True)
-                    self.playToggleBtn.setChecked(True)
-                    self.playToggleBtn.blockSignals(False)
-                    return
-            self.recordBtn.setChecked(False)
+            # live recordings download on their own, they go on while paused
             self.player.pause()
             self.timeStampTimer.stop()
         if self.seekSlider.value() == self.seekSlider.maximum():
             self.liveBtn.setDown(play)
-        self.recordBtn.setEnabled(play or self.toggleRecPanelBtn.isChecked() and self.canRecord())
+        self.recordBtn.setEnabled(play or self.liveRecorder is not None or 
+            self.toggleRecPanelBtn.isChecked() and self.canRecord())
 
     def toggleRecord(self, rec):
         if rec:
             if self.toggleRecPanelBtn.isChecked() and self.seekSlider.recStart() >= 0 and self.seekSlider.recEnd() > self.seekSlider.recStart():
-                self.recordStart = None
                 radio = self.lastRadio
-                start = self.timeStamps[radio][self.seekSlider.recStart()][1]
-                end = self.timeStamps[radio][self.seekSlider.recEnd()][1]
-                self.createRecording(radio, start, end)
+                start = self.cache.getIndexFromSliderPos(radio, self.seekSlider.recStart()).value()
+                end = self.cache.getIndexFromSliderPos(radio, self.seekSlider.recEnd()).value()
+                if start is not None and end is not None:
+                    self.createRecording(radio, start, end)
                 self.seekSlider.reset()
                 self.recordBtn.blockSignals(True)
                 self.recordBtn.setChecked(False)
                 self.recordBtn.blockSignals(False)
                 return
-            self.recordStart = self.player.currentIndex
+            recordDir = QtCore.QDir(self.recordDir)
+            self.liveRecorder = LiveRecorder(self, self.cache, self.lastRadio, 
+                recordDir.absoluteFilePath('.{}-{}.part'.format(RadioNames[self.lastRadio], 
+                    QtCore.QDateTime.currentDateTime().toString('yyyyMMddhhmmss'))), 
+                # when not playing, start from the latest segment
+                self.player.currentIndex if self.player.currentIndex >= 0 else None)
+            self.liveRecorder.segmentWritten.connect(lambda count, radio=self.lastRadio: 
+                self.statusBar().showMessage('Recording {}: {} segments'.format(
+                    RadioTitles[radio], count), 5000))
         else:
             if QtWidgets.QMessageBox.question(self, 
                 'Stop recording?', 'Recording in process, do you want to stop?', 
@@ -2260,43 +4204,36 @@ class RsiPlayer(QtWidgets.QMainWindow):
                     self.recordBtn.setChecked(True)
                     self.recordBtn.blockSignals(False)
                     return
-            start = self.recordStart
-            self.recordStart = None
-            self.createRecording(self.lastRadio, start, self.player.currentIndex)
-
-        self.seekSlider.setDisabled(rec)
-        self.timeEdit.setDisabled(rec)
-        self.nowPlaying.setDisabled(rec)
-        self.liveBtn.setDisabled(rec)
-        for btn in self.radioGroup.buttons():
-            btn.setDisabled(rec)
-
-    def createRecording(self, radio, start, end):
-        files = []
-        missing = []
-        cacheFiles = self.cache[radio]
-        for index in range(start, end + 1):
-            cacheFile = cacheFiles.get(index)
-            if not cacheFile:
-                missing.append(index)
-            files.append(cacheFile)
-        if missing:
-            for miss in missing:
-                self.requestIndex(miss)
-            QtCore.QTimer.singleShot(250, lambda: self.createRecording(radio, start, end))
-            print('missing recordings!')
-            return
-
-        timeStamps = iter(reversed(self.timeStamps[radio]))
-        startTime = endTime = None
-        t = QtCore.QDateTime.currentDateTime()
-        while not all((startTime, endTime)):
-            length, index = next(timeStamps)
-            if index == end + 1:
-                endTime = t.addMSecs(-length)
-            t = t.addMSecs(-length)
-            if index == start:
-                startTime = t
+            recorder = self.liveRecorder
+            self.liveRecorder = None
+            start, end = recorder.stop()
+            if end is None:
+                os.remove(recorder.filePath)
+            else:
+                recFilePath = self.recordFilePath(recorder.radio, start, end)
+                os.replace(recorder.filePath, recFilePath)
+                self.recordingExported(recFilePath)
+
+    def createRecording(self, radio, start, end, pin=None):
+        recFilePath = self.recordFilePath(radio, start, end)
+
+        # the pin is released by the exporter when done
+        exporter = RecordingExporter(self, self.cache, radio, start, end, recFilePath, pin)
+        exporter.fetching.connect(self.exportStatusWidget.setFetchStatus)
+        exporter.progress.connect(self.exportStatusWidget.setExportStatus)
+        self.exportStatusWidget.cancelRequested.connect(exporter.cancel)
+        exporter.exported.connect(self.recordingExported)
+        exporter.failed.connect(lambda error: self.statusBar().showMessage(
+            'Recording failed: {}'.format(error), 5000))
+        exporter.exportRecording()
+
+    def recordFilePath(self, radio, start, end, recordName=None):
+        startTime = self.cache.getTimeFromIndex(radio, start)
+        endTime = self.cache.getTimeFromIndex(radio, end, end=True)
+        if not startTime or not endTime:
+            # no timing information, assume the range ends now
+            endTime = QtCore.QDateTime.currentDateTime()
+            startTime = endTime.addSecs(-(end - start + 1) * 10)
 
         fmt = 'yyyyMMddhhmmss'
 
@@ -2305,22 +4242,77 @@ class RsiPlayer(QtWidgets.QMainWindow):
             startTime = startTime.toString(fmt), 
             endTime = endTime.toString(fmt), 
             )
-        recordName = RecordNameDialog(self).exec_()
+        if recordName is None:
+            recordName = RecordNameDialog(self).exec_()
         fileName = '{}{}.aac'.format(baseName, recordName)
         newIndex = 0
         while QtCore.QDir(self.recordDir).exists(fileName):
             newIndex += 1
             fileName = '{}{}-{}.aac'.format(baseName, recordName, newIndex)
-        recFilePath = QtCore.QDir(self.recordDir).absoluteFilePath(fileName)
-#        recFilePath = cacheDir.absoluteFilePath(fileName)
-        cacheDir = self.cacheDirs[radio]
-        with open(recFilePath, 'wb') as recFile:
-            for sourceName in files:
-                cacheDir.absoluteFilePath(fileName)
-                sourcePath = cacheDir.absoluteFilePath(sourceName)
-                with open(sourcePath, 'rb') as source:
-                    recFile.write(source.read())
-        
+        return QtCore.QDir(self.recordDir).absoluteFilePath(fileName)
+
+    def scheduledRecordingDone(self, partFilePath, radio, start, end, title):
+        recFilePath = self.recordFilePath(radio, start, end, title.replace('/', '_'))
+        os.replace(partFilePath, recFilePath)
+        self.recordModel.getRecordings()
+        self.trayIcon.showMessage('Recording completed', '{}: {}'.format(RadioTitles[radio], title), 
+            self.windowIcons[radio])
+
+    def fillScheduleMenu(self, menu, radios):
+        # upcoming programs of each radio, checked if they are going to be
+        # recorded; other scheduled recordings are listed at the end
+        menu.clear()
+        now = QtCore.QDateTime.currentDateTime()
+        shown = set()
+        for radio in radios:
+            menu.addSection(self.windowIcons[radio], RadioTitles[radio])
+            nowAndNext = self.nowAndNext[radio]
+            if not nowAndNext:
+                self.requestNowAndNext(radio)
+                menu.addAction('Loading programs...').setEnabled(False)
+                continue
+            times = sorted(nowAndNext)
+            for start, end in zip(times, times[1:]):
+                if end <= now:
+                    continue
+                title = nowAndNext[start]['title']
+                recording = self.scheduler.find(radio, start.toMSecsSinceEpoch())
+                action = menu.addAction('{} {}'.format(start.toString('hh:mm'), title))
+                action.setCheckable(True)
+                action.setChecked(bool(recording))
+                if recording:
+                    shown.add(recording)
+                    action.triggered.connect(lambda _, recording=recording: self.scheduler.remove(recording))
+                else:
+                    action.triggered.connect(lambda _, radio=radio, start=start, end=end, title=title: 
+                        self.scheduler.add(radio, start, end, title))
+        others = [recording for recording in self.scheduler.scheduled if not recording in shown]
+        if others:
+            menu.addSection('Scheduled')
+            for recording in others:
+                start = QtCore.QDateTime.fromMSecsSinceEpoch(recording.start)
+                end = QtCore.QDateTime.fromMSecsSinceEpoch(recording.end)
+                action = menu.addAction(self.windowIcons[recording.radio], '{} {}-{} {}'.format(
+                    start.toString('dd/MM'), start.toString('hh:mm'), end.toString('hh:mm'), recording.title))
+                action.setCheckable(True)
+                action.setChecked(True)
+                action.triggered.connect(lambda _, recording=recording: self.scheduler.remove(recording))
+        menu.addSeparator()
+        menu.addAction('Time range...').triggered.connect(
+            lambda: self.scheduleTimeRange(radios[0] if len(radios) == 1 else self.lastRadio))
+
+    def scheduleTimeRange(self, radio):
+        result = ScheduleDialog(self, radio).exec_()
+        if result:
+            self.scheduler.add(*result)
+
+    def nowPlayingMenu(self, pos):
+        menu = self.nowPlaying.createStandardContextMenu()
+        scheduleMenu = menu.addMenu(QtGui.QIcon('record.svg'), 'Schedule recording')
+        self.fillScheduleMenu(scheduleMenu, [self.lastRadio])
+        menu.exec_(self.nowPlaying.viewport().mapToGlobal(pos))
+
+    def recordingExported(self, filePath):
         self.togglePanelBtn.setChecked(True)
         self.panel.setCurrentWidget(self.recordTree)
         self.recordModel.getRecordings()
@@ -2460,6 +4452,9 @@ class RsiPlayer(QtWidgets.QMainWindow):
         reply.setProperty('radio', radio)
         reply.finished.connect(self.songLogReceived)
         self.songLogRequestElapsed.start()
+        self.requestNowAndNext(radio)
+
+    def requestNowAndNext(self, radio):
         req = QtNetwork.QNetworkRequest(QtCore.QUrl(NowAndNextUrls[radio]))
         reply = self.manager.get(req)
         reply.setProperty('radio', radio)
@@ -2775,7 +4770,10 @@ class RsiPlayer(QtWidgets.QMainWindow):
     def reloadLog(self):
         vPos = self.nowPlaying.verticalScrollBar().value()
         html = u'<xhtml><body>'
-        for song in self.songLogs[self.lastRadio]:
+        songLog = self.songLogs[self.lastRadio]
+        results = self.cache.getIndexesFromTimes(self.lastRadio, 
+            [QtCore.QTime.fromString(song.get('timeOfPlayback')) for song in songLog])
+        for song, res in zip(songLog, results):
             artist = song.get('artist')
             if isinstance(artist, dict):
                 artist = artist.get('name')
@@ -2789,7 +4787,6 @@ class RsiPlayer(QtWidgets.QMainWindow):
 
             #TODO: reload playlist on mouseover?
             # hjhoahaojhaojaho
-            res = self.cache.getIndexFromTime(self.lastRadio, QtCore.QTime.fromString(realTimeStr))
             if res.isValid():
                 href = ' href="radio/{radio}/{realTime}"'.format(
                     radio=self.lastRadio, 
@@ -2939,23 +4936,13 @@ class RsiPlayer(QtWidgets.QMainWindow):
             # broadcast settings and encoding/network time); let's assume a 
             # default 50 seconds offset...
             offsetMSecs = self.settings.value('seekOffset', 50, type=int) * 1000
-            now = QtCore.QDateTime.currentDateTime()
-            minTime = now.addSecs(-21600)
-            revKeys = list(sorted(contents.keys(), reverse=True))
-            for contentIndex in revKeys:
-                
-                info = contents[contentIndex]
-                now = now.addMSecs(info.length)
-                if now < minTime:
-                    index = min(index, contentIndex + 1)
-                if contentIndex > index:
-                    continue
-                offsetMSecs -= contents[contentIndex].length
-                if offsetMSecs < 0:
-                    index = contentIndex
-                    break
+            segmentIndex = self.cache.indexToFile[radio]
+            # go back to the first segment that ends after the offset
+            pos = segmentIndex.positionAt(segmentIndex.endOf(index) - offsetMSecs - 1)
+            if pos >= 0:
+                index = int(segmentIndex.indexes[pos])
 
-            self.liveBtn.setDown(index <= min(revKeys[1:]))
+            self.liveBtn.setDown(index <= segmentIndex.indexes[0])
 
             if self.cache.getPathFromIndex(radio, index, notify=True):
                 self.player.start(index, self.lastRadio)